@@ -25,11 +25,22 @@ Dependencies
     xarray, numpy, glob, and functools.
 """
 
+import base64
 import cftime
+import fnmatch
 import glob
+import hashlib
+import inspect
+import json
+import os
+import re
+import sqlite3
+import warnings
 import numpy as np
 import xarray as xr
-from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 
 def file_dict(filetempl, filetype, mem, stmon):
@@ -72,30 +83,1478 @@ def file_dict(filetempl, filetype, mem, stmon):
     return filepaths
 
 
+def file_index(filetemplate, filetype, nthreads=None):
+    """
+    Scans the archive once and returns an index of every file matching the
+    template, for all ensemble members and initialization months. The
+    returned index can be passed to nested_file_list_by_year and
+    get_monthly_data in place of repeated calls to file_dict.
+
+    Parameters
+    ----------
+    filetemplate : str
+        file template; 'MM' and 'EEE' are matched for all months and members.
+        A template with named keys in braces is parsed with parse_template
+    filetype : str
+        file ending (not used for templates with named keys)
+    nthreads : int (optional)
+        if set, directories are listed concurrently by this many threads
+        instead of by a serial glob; useful on high-latency parallel
+        filesystems
+
+    Returns
+    -------
+    index : dict
+        dictionary keyed by (field, stmon, mem), each entry a dictionary
+        of filepaths keyed by initialization year (as returned by file_dict)
+    """
+
+    if '{' in filetemplate:
+        # named template, see parse_template
+        template = parse_template(filetemplate)
+        if not {'year', 'month', 'member'} <= set(template.types):
+            raise ValueError('ERROR: template must contain year, month and member keys')
+        filetemp = template.glob
+        parse = partial(_parse_template_path, template=template)
+    else:
+        filetemp = filetemplate.replace('MM', '??').replace('EEE', '???')
+        parse = partial(_parse_path, filetype=filetype)
+    index = {}
+
+    # find all the relevant files in a single pass
+    if nthreads:
+        files = _parallel_glob(filetemp, nthreads)
+    else:
+        files = sorted(glob.glob(filetemp))
+
+    for file in files:
+        keys = parse(file)
+        if keys is None:
+            continue
+        y0, stmon, mem, field = keys
+        index.setdefault((field, stmon, mem), {})[y0] = file
+
+    return index
+
+
+FileTemplate = namedtuple('FileTemplate', ['glob', 'regex', 'types'])
+FileTemplate.__doc__ = """
+Compiled file template returned by parse_template: a glob pattern matching
+candidate files, a regular expression extracting the named keys from a path,
+and the type (int or str) of each key.
+"""
+
+
+def parse_template(filetemplate):
+    """
+    Compiles a file template with named keys in braces, eg
+    '/path/{case}.{year:4d}-{month:02d}.{member:03d}.pop.h.{field}.*.nc',
+    into a glob pattern and a regular expression which extracts every key
+    from a path in one match. Keys with a 'd' format are integers, matching
+    exactly that many digits if a width is given; other keys are strings
+    that do not cross directories. A key repeated in the template (eg the
+    year in both the directory and the file name) must match the same text.
+    '*' and '?' outside braces are glob wildcards.
+
+    file_index recognizes templates containing braces and reads the keys
+    year, month, member and field (field is optional for single-field
+    templates), so any archive layout can be indexed in a single scan.
+
+    Parameters
+    ----------
+    filetemplate : str
+        file template with named keys
+
+    Returns
+    -------
+    template : FileTemplate
+        glob pattern, compiled regular expression and key types
+    """
+
+    pattern = ''
+    regex = ''
+    types = {}
+    for i, part in enumerate(re.split(r'\{([^{}]*)\}', filetemplate)):
+        if i % 2 == 0:
+            # literal text, possibly with glob wildcards
+            pattern += part
+            regex += ''.join('[^/]*' if char == '*' else '[^/]' if char == '?'
+                             else re.escape(char) for char in part)
+            continue
+        name, _, fmt = part.partition(':')
+        if not name.isidentifier():
+            raise ValueError('ERROR: invalid template key {}'.format(part))
+        if fmt and not fmt.endswith('d'):
+            raise ValueError('ERROR: unsupported template format {}'.format(part))
+        width = int(fmt[:-1]) if fmt[:-1] else None
+        if name in types:
+            pattern += '?' * width if width else '*'
+            regex += '(?P={})'.format(name)
+            continue
+        types[name] = int if fmt else str
+        if fmt:
+            pattern += '?' * width if width else '*'
+            regex += r'(?P<{}>\d{})'.format(name, '{%d}' % width if width else '+')
+        else:
+            pattern += '*'
+            regex += '(?P<{}>[^/]*?)'.format(name)
+
+    return FileTemplate(pattern, re.compile(regex), types)
+
+
+def _parse_template_path(file, template):
+    """
+    Returns initialization year, month, ensemble member and field of a file
+    from a compiled template, or None if the file does not match it.
+    """
+
+    match = template.regex.fullmatch(file)
+    if match is None:
+        return None
+    keys = {name: template.types[name](value) for name, value in match.groupdict().items()}
+
+    return keys['year'], keys['month'], keys['member'], keys.get('field')
+
+
+def _parse_path(file, filetype):
+    """
+    Isolates initialization year, month, ensemble member and field from
+    a file name following the SMYLE naming convention. Returns None if
+    the file name cannot be parsed.
+    """
+
+    parts = file.split(filetype)
+    if len(parts) < 2:
+        return None
+    ystr = parts[0]
+    try:
+        y0 = int(ystr[-11:-7])
+        stmon = int(ystr[-6:-4])
+        mem = int(ystr[-3:])
+    except ValueError:
+        return None
+    field = parts[1].split('.')[0]
+
+    return y0, stmon, mem, field
+
+
+def _parallel_glob(pattern, nthreads):
+    """
+    Returns the sorted list of paths matching a glob pattern. Directories
+    are listed level by level with os.scandir, each level fanned out over
+    a bounded thread pool.
+    """
+
+    parts = [part for part in pattern.split(os.sep) if part]
+    paths = [os.sep] if os.path.isabs(pattern) else ['']
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for level, part in enumerate(parts):
+            last = level == len(parts) - 1
+            if not glob.has_magic(part):
+                # literal component; no listing required
+                paths = [os.path.join(path, part) for path in paths]
+                if last:
+                    paths = [path for path in paths if os.path.lexists(path)]
+                continue
+            listings = pool.map(partial(_scandir_match, pattern=part, dirs_only=not last),
+                                paths)
+            paths = [path for listing in listings for path in listing]
+
+    return sorted(paths)
+
+
+def _scandir_match(path, pattern, dirs_only):
+    """
+    Lists the entries of directory path whose names match pattern.
+    """
+
+    matches = []
+    try:
+        with os.scandir(path or os.curdir) as entries:
+            for entry in entries:
+                # follow glob in not matching hidden names with wildcards
+                if entry.name.startswith('.') and not pattern.startswith('.'):
+                    continue
+                if not fnmatch.fnmatchcase(entry.name, pattern):
+                    continue
+                if dirs_only and not entry.is_dir():
+                    continue
+                matches.append(os.path.join(path, entry.name))
+    except OSError:
+        pass
+
+    return matches
+
+
+def build_catalog(filetemplate, filetype, catalog):
+    """
+    Builds or updates a persistent SQLite catalog of the files matching the
+    template, for all ensemble members and initialization months. Only
+    directories whose modification time, or whose cataloged files' sizes or
+    modification times, changed since the last scan for this template are
+    rescanned; directories that no longer exist are dropped from
+    the catalog. Several templates (eg fields) may share one catalog and one
+    directory.
+
+    Parameters
+    ----------
+    filetemplate : str
+        file template; 'MM' and 'EEE' are matched for all months and members
+    filetype : str
+        file ending
+    catalog : str
+        path of the SQLite catalog file; created if it does not exist
+
+    Returns
+    -------
+    nscanned : int
+        number of directories that were (re)scanned
+    """
+
+    filetemp = filetemplate.replace('MM', '??').replace('EEE', '???')
+    dirtemp, basetemp = os.path.split(filetemp)
+    dirtemp = dirtemp or os.curdir
+    component = filetype.strip('.').split('.')[0]
+    nscanned = 0
+
+    con = sqlite3.connect(catalog)
+    with con:
+        con.executescript(_CATALOG_SCHEMA)
+        dirmatch = _path_regex(dirtemp)
+        known = {dd: mtime for dd, mtime in
+                 con.execute('SELECT dir, mtime FROM scans WHERE dir GLOB ? AND template = ?',
+                             (dirtemp, basetemp))
+                 if dirmatch.match(dd)}
+        dirs = sorted(glob.glob(dirtemp))
+
+        # drop directories which have disappeared from the archive
+        for dd in set(known) - set(dirs):
+            _delete_matching(con, dd, basetemp)
+            con.execute('DELETE FROM scans WHERE dir = ? AND template = ?', (dd, basetemp))
+
+        for dd in dirs:
+            mtime = os.stat(dd).st_mtime
+            if known.get(dd) == mtime and not _stale_files(con, dd, basetemp):
+                continue
+            # directory is new, or it or one of its files has changed; rescan its entries
+            rows = []
+            with os.scandir(dd) as entries:
+                for entry in entries:
+                    if not fnmatch.fnmatchcase(entry.name, basetemp):
+                        continue
+                    file = os.path.join(dd if dd != os.curdir else '', entry.name)
+                    keys = _parse_path(file, filetype)
+                    if keys is None:
+                        continue
+                    stat = entry.stat()
+                    trange = file.split(filetype)[1].split('.')
+                    trange = trange[1].split('-') if len(trange) > 2 else []
+                    tstart, tend = (trange + [None, None])[:2]
+                    rows.append((file, dd) + keys + (component, stat.st_size,
+                                                      stat.st_mtime, tstart, tend))
+            # only replace the files of this template, other fields may share the directory
+            _delete_matching(con, dd, basetemp)
+            con.executemany('INSERT INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+            con.execute('INSERT OR REPLACE INTO scans VALUES (?,?,?)', (dd, basetemp, mtime))
+            nscanned += 1
+    con.close()
+
+    return nscanned
+
+
+def _delete_matching(con, dd, basetemp):
+    """
+    Deletes the catalog rows of the files in directory dd whose name matches basetemp.
+    """
+    paths = [(path,) for path, in con.execute('SELECT path FROM files WHERE dir = ?', (dd,))
+             if fnmatch.fnmatchcase(os.path.basename(path), basetemp)]
+    con.executemany('DELETE FROM files WHERE path = ?', paths)
+
+
+def _stale_files(con, dd, basetemp):
+    """
+    Returns the cataloged files in directory dd matching basetemp which no
+    longer exist or whose size or modification time changed.
+    """
+    rows = con.execute('SELECT path, size, mtime FROM files WHERE dir = ?', (dd,))
+
+    return [path for path, size, mtime in rows
+            if fnmatch.fnmatchcase(os.path.basename(path), basetemp) and
+            _file_changed(path, size, mtime)]
+
+
+def _file_changed(path, size, mtime):
+    """
+    Returns True if the file at path is missing or differs in size or
+    modification time from the cataloged values.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return True
+
+    return (stat.st_size, stat.st_mtime) != (size, mtime)
+
+
+def _path_regex(pattern):
+    """
+    Compiles a glob pattern into a regular expression in which '*', '?' and
+    character sets do not match the path separator, as in glob.glob (unlike
+    SQLite GLOB).
+    """
+
+    sep = re.escape(os.sep)
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        end = pattern.find(']', i + 2) if char == '[' else -1
+        if char == '*':
+            regex += '[^{}]*'.format(sep)
+        elif char == '?':
+            regex += '[^{}]'.format(sep)
+        elif end > 0:
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '(?!{})[{}]'.format(sep, chars.replace('\\', '\\\\'))
+            i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    return re.compile(regex + r'\Z')
+
+
+def catalog_index(catalog, filetemplate, check=True):
+    """
+    Returns a file index (see file_index) for the files in a catalog written
+    by build_catalog which match the template, without listing the archive.
+
+    Parameters
+    ----------
+    catalog : str
+        path of the SQLite catalog file
+    filetemplate : str
+        file template; 'MM' and 'EEE' are matched for all months and members
+    check : bool (optional)
+        defaults to True; if set, the files are checked against the sizes and
+        modification times in the catalog, and a ValueError is raised if any
+        is missing or changed (the catalog should then be rebuilt)
+
+    Returns
+    -------
+    index : dict
+        dictionary keyed by (field, stmon, mem), each entry a dictionary
+        of filepaths keyed by initialization year
+    """
+
+    filetemp = filetemplate.replace('MM', '??').replace('EEE', '???')
+    index = {}
+
+    con = sqlite3.connect(catalog)
+    rows = con.execute('SELECT path, year, month, member, field, size, mtime FROM files '
+                       'WHERE path GLOB ? ORDER BY path', (filetemp,)).fetchall()
+    con.close()
+
+    # SQLite GLOB wildcards also match the path separator
+    pathmatch = _path_regex(filetemp)
+    rows = [row for row in rows if pathmatch.match(row[0])]
+    if check:
+        stale = [row[0] for row in rows if _file_changed(row[0], *row[5:])]
+        if stale:
+            raise ValueError('ERROR: {} files changed since the catalog was built, eg {}; '
+                             'rerun build_catalog'.format(len(stale), stale[0]))
+
+    for file, y0, stmon, mem, field, size, mtime in rows:
+        index.setdefault((field, stmon, mem), {})[y0] = file
+
+    return index
+
+
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    dir TEXT,
+    template TEXT,
+    mtime REAL,
+    PRIMARY KEY (dir, template)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    year INTEGER,
+    month INTEGER,
+    member INTEGER,
+    field TEXT,
+    component TEXT,
+    size INTEGER,
+    mtime REAL,
+    time_start TEXT,
+    time_end TEXT
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+"""
+
+
+def _index_filepaths(index, mem, stmon, field=None):
+    """
+    Returns the dictionary of filepaths keyed by initialization year for
+    one ensemble member and initialization month from a file index. If
+    field is None, files for every field in the index are included; index
+    entries without a field (templates without {field}) match any field.
+    """
+
+    filepaths = {}
+    for (ff, mm, ee), paths in index.items():
+        if mm == stmon and ee == mem and (field is None or ff is None or ff == field):
+            filepaths.update(paths)
+
+    return filepaths
+
+
 def get_monthly_data(filetemplate, filetype, ens, nlead, field,
-                     start_years, stmon, preproc, chunks={}):
+                     start_years, stmon, preproc, chunks={}, index=None, catalog=None,
+                     nthreads=None, share_time=False, references=None, region=None,
+                     method='mfdataset', max_workers=None, cache_dir=None,
+                     cache_maxsize=None):
+    """
+    Returns a dask array containing the requested hindcast ensemble.
+
+    Parameters
+    ----------
+    nfiletemplate : str
+        file template
+    filetype : str
+        file ending
+    ens : int
+        ensemble member
+    nlead : int
+        number of months over which data is read; allows for a partial read
+        of the data and controls the time dimension of returned dask array
+    field : str or list
+        variable to be examined, eg 'TREFHT'. A list of variables, eg
+        ['TS', 'PSL'], is read into a single Dataset; filetemplate must
+        then match the files of every field (eg '*' in place of the field
+        name), and the file lists are resolved from one scan of the archive.
+    startyears : list
+        list of start years which are integers
+    stmon : str or list
+        month. A list of initialization months, eg [2, 5, 8, 11], is read
+        into a single Dataset with an additional dimension "S" (start month),
+        dimensioned (Y,L,M,S,...); only start years available for every
+        month are kept, and each (S,Y) must have the same number of members.
+    preproc : func
+        preprocessing function
+    chunks : dict
+        chunks for dask array, defaults to {}
+    index : dict (optional)
+        file index returned by file_index; scanned from filetemplate if None
+    catalog : str (optional)
+        SQLite catalog written by build_catalog; queried instead of
+        scanning the archive if no index is given
+    nthreads : int (optional)
+        number of threads used to list the archive (see file_index)
+    share_time : bool (optional)
+        defaults to False; if True, the time axis of the files is not decoded
+        (other variables are) and preproc receives raw numeric time values,
+        which the default preprocessor leaves as they are unless freq is set.
+        The (Y,L) time axis of the assembled hindcast is then decoded to
+        mid-month dates once and shared by all members.
+    references : str (optional)
+        reference file written by build_references; if given, the hindcast
+        is opened from it as one virtual Zarr store and no files are
+        discovered or opened individually (preproc is not applied)
+    region : dict or tuple (optional)
+        spatial subset applied to each file as it is opened, before preproc,
+        so that only the needed hyperslab is read (see subset_region)
+    method : str (optional)
+        'mfdataset' (default) combines the files with xr.open_mfdataset.
+        'direct' trusts the layout of the first file and builds the dask
+        array from one deterministic netCDF4 read per file, bypassing the
+        xarray combine machinery; preproc is then not applied, the field
+        is returned as stored with mid-month times as set by preprocessor,
+        and region must be a dict of indexers.
+        'processes' reads and preprocesses the files in a ProcessPoolExecutor,
+        without a dask cluster, gathering the results into shared memory;
+        the hindcast is returned loaded into memory (not as dask arrays)
+        and preproc must be picklable (eg a module-level function or a
+        functools.partial of one).
+    max_workers : int (optional)
+        number of worker processes for method 'processes'; defaults to the
+        number of CPUs
+    cache_dir : str (optional)
+        directory of cached results. The result is stored there as NetCDF,
+        keyed by a hash of the esp_lab version, the arguments, preproc (its
+        source, default arguments, closure contents and referenced globals,
+        and the arguments of a functools.partial) and of the paths, sizes
+        and modification times of the member files, and reopened (lazily)
+        by repeated calls instead of being read again. Caching is turned
+        off, with a warning, if an argument cannot be hashed deterministically
+    cache_maxsize : int (optional)
+        maximum size of cache_dir in bytes; least recently used results
+        are removed beyond it. Defaults to None (no limit)
+
+    Returns
+    -------
+    ds0 : dask array
+        dask array containing requested hindcast ensemble
+    """
+
+    if references is not None:
+        return open_references(references, field, nlead, start_years, chunks=chunks)
+
+    if cache_dir is not None:
+        # discover files once, both for the cache key and for reading
+        if index is None and catalog is not None:
+            index = catalog_index(catalog, filetemplate)
+        elif index is None:
+            index = file_index(filetemplate, filetype, nthreads=nthreads)
+        files = []
+        for ff in [field] if isinstance(field, str) else field:
+            for mm in [stmon] if np.ndim(stmon) == 0 else stmon:
+                file_list = nested_file_list_by_year(
+                    filetemplate, filetype, ens, start_years, mm, index=index, field=ff)[0]
+                files.extend(file for yfiles in file_list for file in yfiles)
+        from esp_lab import __version__
+
+        key = hashlib.sha1()
+        try:
+            _hash_update(key, [__version__, filetemplate, filetype, ens, nlead, field,
+                               start_years, stmon, share_time, region, preproc, method])
+        except TypeError as err:
+            # an argument without a deterministic hash; do not cache
+            warnings.warn('{}, caching is turned off'.format(err))
+            return get_monthly_data(filetemplate, filetype, ens, nlead, field, start_years,
+                                    stmon, preproc, chunks=chunks, index=index,
+                                    share_time=share_time, region=region, method=method,
+                                    max_workers=max_workers)
+        for file in files:
+            stat = os.stat(file)
+            key.update('{}:{}:{}'.format(file, stat.st_size, stat.st_mtime_ns).encode())
+        cache_file = os.path.join(cache_dir, key.hexdigest() + '.nc')
+
+        if not os.path.exists(cache_file):
+            ds0 = get_monthly_data(filetemplate, filetype, ens, nlead, field, start_years,
+                                   stmon, preproc, chunks=chunks, index=index,
+                                   share_time=share_time, region=region, method=method,
+                                   max_workers=max_workers)
+            # on-disk layout of the source files does not apply to the result
+            ds0.encoding = {}
+            for var in ds0.variables.values():
+                var.encoding = {}
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+            ds0.to_netcdf(tmp_file)
+            os.replace(tmp_file, cache_file)
+        # mark as recently used, then evict the least recently used results
+        os.utime(cache_file)
+        _evict_cache(cache_dir, cache_maxsize, keep=cache_file)
+
+        return xr.open_dataset(cache_file, chunks={})
+
+    if method == 'mfdataset':
+        opener = _open_nested
+    elif method == 'direct':
+        opener = _open_direct
+    elif method == 'processes':
+        opener = partial(_open_processes, max_workers=max_workers)
+    else:
+        raise ValueError('ERROR: unknown method {}'.format(method))
+
+    if isinstance(field, str) and np.ndim(stmon) == 0:
+        # Retrieve nested list of files
+        file_list, yrs = nested_file_list_by_year(filetemplate, filetype, ens,
+                                                  start_years, stmon, index=index,
+                                                  catalog=catalog, nthreads=nthreads,
+                                                  field=field)
+        return opener(file_list, {"Y": yrs}, nlead, field, preproc, chunks,
+                      share_time, region)
+
+    # several fields or start months; resolve all file lists from a single scan
+    fields = [field] if isinstance(field, str) else list(field)
+    stmons = [stmon] if np.ndim(stmon) == 0 else list(stmon)
+    if index is None and catalog is not None:
+        index = catalog_index(catalog, filetemplate)
+    elif index is None:
+        index = file_index(filetemplate, filetype, nthreads=nthreads)
+    nested = {(ff, mm): nested_file_list_by_year(filetemplate, filetype, ens, start_years, mm,
+                                                 index=index, field=ff)
+              for ff in fields for mm in stmons}
+    # only keep start years available for every field and start month
+    yrs = [yy for yy in nested[(fields[0], stmons[0])][1]
+           if all(yy in fyrs for files, fyrs in nested.values())]
+    concat_coords = {"Y": yrs} if np.ndim(stmon) == 0 else {"S": stmons, "Y": yrs}
+
+    dslist = []
+    for ff in fields:
+        file_list = []
+        for mm in stmons:
+            files, fyrs = nested[(ff, mm)]
+            file_list.append([files[fyrs.index(yy)] for yy in yrs])
+        if np.ndim(stmon) == 0:
+            file_list = file_list[0]
+        dslist.append(opener(file_list, concat_coords, nlead, ff, preproc, chunks,
+                             share_time, region))
+    ds0 = xr.merge(dslist, compat="override", combine_attrs="override")
+
+    return ds0
+
+
+def _hash_update(key, obj, seen=None):
+    """
+    Updates the hashlib object key with the content of obj, including the
+    source code, default arguments, closure contents and referenced globals
+    of functions and the arguments of functools.partial. Raises TypeError
+    for values which cannot be hashed deterministically.
+    """
+
+    seen = set() if seen is None else seen
+    if isinstance(obj, partial):
+        _hash_update(key, [obj.func, obj.args, obj.keywords], seen)
+    elif inspect.isfunction(obj):
+        key.update('{}.{}'.format(obj.__module__, obj.__qualname__).encode())
+        if id(obj) in seen:
+            # recursive reference, already hashed
+            return
+        seen.add(id(obj))
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = obj.__code__.co_code.hex() + repr(obj.__code__.co_consts)
+        key.update(source.encode())
+        cells = [_cell_contents(cell) for cell in obj.__closure__ or ()]
+        # globals referenced by name, eg helper functions and constants
+        names = sorted(name for name in _code_names(obj.__code__)
+                       if name in obj.__globals__ and
+                       not inspect.ismodule(obj.__globals__[name]))
+        _hash_update(key, [obj.__defaults__, obj.__kwdefaults__, cells,
+                           {name: obj.__globals__[name] for name in names}], seen)
+    elif hasattr(obj, '__wrapped__') and callable(obj):
+        # eg functions decorated with functools.lru_cache
+        _hash_update(key, obj.__wrapped__, seen)
+    elif isinstance(obj, dict):
+        for name in sorted(obj, key=str):
+            key.update(repr(name).encode())
+            _hash_update(key, obj[name], seen)
+    elif isinstance(obj, (list, tuple)):
+        key.update('{}:{}'.format(type(obj).__name__, len(obj)).encode())
+        for item in obj:
+            _hash_update(key, item, seen)
+    elif isinstance(obj, (np.ndarray, xr.DataArray)):
+        values = np.asarray(obj)
+        key.update('{}{}'.format(values.dtype, values.shape).encode())
+        if values.dtype == object:
+            _hash_update(key, values.ravel().tolist(), seen)
+        else:
+            key.update(np.ascontiguousarray(values).tobytes())
+    elif hasattr(obj, 'tocsr'):
+        # scipy sparse matrix, eg SparseWeights
+        matrix = obj.tocsr()
+        _hash_update(key, [matrix.shape, matrix.data, matrix.indices, matrix.indptr], seen)
+    elif isinstance(obj, (type, np.ufunc)) or inspect.isbuiltin(obj):
+        key.update('{}.{}'.format(getattr(obj, '__module__', None),
+                                  getattr(obj, '__qualname__', obj.__name__)).encode())
+    elif obj is None or isinstance(obj, (str, bytes, int, float, complex, slice, range,
+                                         np.generic, np.dtype, cftime.datetime)):
+        key.update('{}:{!r}'.format(type(obj).__name__, obj).encode())
+    else:
+        raise TypeError('ERROR: cannot hash {} deterministically'.format(type(obj).__name__))
+
+
+def _cell_contents(cell):
+    """
+    Returns the contents of a closure cell, or None if it is still empty.
+    """
+
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None
+
+
+def _code_names(code):
+    """
+    Returns the global names used by a code object and the code objects
+    nested in it (eg lambdas and comprehensions).
+    """
+
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+
+    return names
+
+
+def _evict_cache(cache_dir, cache_maxsize, keep=None):
+    """
+    Removes the least recently used results from cache_dir until it is no
+    larger than cache_maxsize bytes, never removing keep.
+    """
+
+    if cache_maxsize is None:
+        return
+    entries = sorted((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+                     for entry in os.scandir(cache_dir) if entry.name.endswith('.nc'))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if total <= cache_maxsize:
+            break
+        if path != keep:
+            os.remove(path)
+            total -= size
+
+
+def iter_monthly_data(filetemplate, filetype, ens, nlead, field, start_years, stmon,
+                      preproc, block=1, by_member=False, reduce=None, chunks={},
+                      index=None, catalog=None, nthreads=None, share_time=False,
+                      region=None):
+    """
+    Generator which streams the requested hindcast ensemble in blocks of
+    start years, or of single (start year, member) files, each one fully
+    loaded into memory. Memory use is bounded by the block size rather
+    than the size of the archive; a reduction (eg seasonal averaging,
+    regional means or drift accumulation) can be applied to each block
+    before it is loaded.
+
+    Parameters
+    ----------
+    filetemplate : str
+        file template
+    filetype : str
+        file ending
+    ens : int
+        ensemble member
+    nlead : int
+        number of months over which data is read
+    field : str or list
+        variable to be examined, eg 'TREFHT' (see get_monthly_data)
+    start_years : list
+        list of start years which are integers
+    stmon : str or list
+        month (see get_monthly_data)
+    preproc : func
+        preprocessing function
+    block : int (optional)
+        number of start years per block, defaults to 1
+    by_member : bool (optional)
+        defaults to False; if True, each (start year, member) file is
+        yielded separately and block is ignored. Requires a single field
+        and start month.
+    reduce : func (optional)
+        function applied to each lazy block, in the (Y,L,M,...) layout of
+        get_monthly_data, before it is loaded
+    chunks, index, catalog, nthreads, share_time, region : optional
+        passed to get_monthly_data
+
+    Yields
+    ------
+    ds0 : xarray
+        loaded (and optionally reduced) block of the hindcast ensemble
+    """
+
+    # discover files once for all blocks
+    if index is None and catalog is not None:
+        index = catalog_index(catalog, filetemplate)
+    elif index is None:
+        index = file_index(filetemplate, filetype, nthreads=nthreads)
+
+    if by_member:
+        if not isinstance(field, str) or np.ndim(stmon) != 0:
+            raise ValueError('ERROR: by_member requires a single field and start month')
+        file_list, yrs = nested_file_list_by_year(filetemplate, filetype, ens, start_years,
+                                                  stmon, index=index, field=field)
+        for yy, ffs in zip(yrs, file_list):
+            for i, file in enumerate(ffs):
+                ds0 = _open_nested([[file]], {"Y": [yy]}, nlead, field, preproc, chunks,
+                                   share_time, region)
+                ds0["M"] = [i + 1]
+                if reduce is not None:
+                    ds0 = reduce(ds0)
+                yield ds0.load()
+        return
+
+    # only stream start years which are in the archive
+    month = stmon if np.ndim(stmon) == 0 else stmon[0]
+    yrs = nested_file_list_by_year(filetemplate, filetype, ens, start_years, month,
+                                   index=index,
+                                   field=field if isinstance(field, str) else field[0])[1]
+    for i in range(0, len(yrs), block):
+        ds0 = get_monthly_data(filetemplate, filetype, ens, nlead, field, yrs[i:i + block],
+                               stmon, preproc, chunks=chunks, index=index,
+                               share_time=share_time, region=region)
+        if reduce is not None:
+            ds0 = reduce(ds0)
+        yield ds0.load()
+
+
+def _open_nested(file_list, concat_coords, nlead, field, preproc, chunks, share_time,
+                 region):
+    """
+    Opens a nested list of files for one field and returns it in the
+    (Y,L,M,...) layout of get_monthly_data. The outer levels of file_list
+    are combined along the dimensions of concat_coords (eg {"Y": yrs}),
+    and the innermost level along "M".
+    """
+
+    # read only the lead hyperslab, aligned with the on-disk chunking
+    first_file = file_list
+    while isinstance(first_file, list):
+        first_file = first_file[0]
+    chunks = lead_chunks(first_file, field, nlead, chunks)
+
+    # open xarray dataset, passing in parameters including preprocessing fxn
+    ds0 = xr.open_mfdataset(file_list,
+                            combine="nested",
+                            # concat_dim depends on how file_list is ordered;
+                            # inner most list of datasets is combined along "M"
+                            # then the outer list(s) along concat_coords, eg "Y"
+                            concat_dim=list(concat_coords) + ["M"],
+                            parallel=True,
+                            # time only varies with "Y" unless start months
+                            # are combined as well
+                            data_vars=[field] if "S" not in concat_coords else [field, "time"],
+                            coords="minimal",
+                            compat="override",
+                            preprocess=partial(_subset_preprocess,
+                                               preproc=preproc,
+                                               region=region,
+                                               share_time=share_time,
+                                               nlead=nlead,
+                                               field=field),
+                            decode_times=_decode_times(share_time),
+                            chunks=chunks)
+
+    if "S" in concat_coords:
+        ds0["time"] = ds0["time"].isel(M=0, drop=True)
+    if share_time:
+        ds0 = _decode_shared_time(ds0)
+
+    # assign final attributes
+    for dim, values in concat_coords.items():
+        ds0[dim] = values
+    ds0["M"] = np.arange(ds0.sizes["M"]) + 1
+
+    # reorder into desired format (Y,L,M,...)
+    ds0 = ds0.transpose("Y", "L", "M", ...)
+
+    return ds0
+
+
+def _open_direct(file_list, concat_coords, nlead, field, preproc, chunks, share_time,
+                 region):
+    """
+    Reads a nested list of files for one field, which must all share the
+    layout of the first file, into the (Y,L,M,...) layout of
+    get_monthly_data without open_mfdataset. Each file becomes one dask
+    chunk read by _read_direct; preproc, chunks and share_time are not used.
+    """
+
+    import dask
+    import dask.array as dsa
+    import netCDF4
+
+    first_file = file_list
+    while isinstance(first_file, list):
+        first_file = first_file[0]
+
+    # layout, coordinates and attributes from the first file
+    region = {} if region is None else region
+    if not isinstance(region, dict):
+        raise ValueError('ERROR: method direct requires region as a dict of indexers')
+    with netCDF4.Dataset(first_file) as nc:
+        var = nc[field]
+        key = (slice(0, nlead),) + tuple(region.get(dim, slice(None))
+                                         for dim in var.dimensions[1:])
+        shape = np.broadcast_to(np.zeros(()), var.shape)[key].shape
+        dims = ["L"] + [dim for dim, k in zip(var.dimensions[1:], key[1:])
+                        if np.ndim(k) > 0 or isinstance(k, slice)]
+        dtype = np.result_type(var.dtype, getattr(var, 'scale_factor', np.float32(0)),
+                               np.float32)
+        attrs = _direct_attrs(var)
+        # every variable on (a subset of) the spatial dimensions becomes a coordinate
+        coords = {}
+        for name, cvar in nc.variables.items():
+            if name == field or not cvar.dimensions or \
+               not set(cvar.dimensions) <= set(var.dimensions[1:]):
+                continue
+            ckey = tuple(region.get(dim, slice(None)) for dim in cvar.dimensions)
+            cdims = [dim for dim, k in zip(cvar.dimensions, ckey)
+                     if np.ndim(k) > 0 or isinstance(k, slice)]
+            values = cvar[ckey]
+            if np.ma.isMaskedArray(values) and np.issubdtype(values.dtype, np.floating):
+                values = values.filled(np.nan)
+            coords[name] = (cdims, np.asarray(values), _direct_attrs(cvar))
+        global_attrs = {att: nc.getncattr(att) for att in nc.ncattrs()}
+
+    read = partial(_read_direct, field=field, key=key, dtype=dtype)
+
+    def stack(files):
+        if isinstance(files, list):
+            return dsa.stack([stack(ff) for ff in files])
+        return dsa.from_delayed(dask.delayed(read, pure=True)(files), shape, dtype=dtype)
+
+    def times(files):
+        # time only varies with the outer levels, so read it from the first member
+        if isinstance(files[0], list):
+            return np.stack([times(ff) for ff in files])
+        with netCDF4.Dataset(files[0]) as nc:
+            time = nc['time']
+            return midmonth_from_num(time[:nlead], time.units,
+                                     getattr(time, 'calendar', 'standard'))
+
+    concat_dims = list(concat_coords)
+    ds0 = xr.Dataset({field: (concat_dims + ["M"] + dims, stack(file_list), attrs),
+                      "time": (concat_dims + ["L"], times(file_list))},
+                     coords=coords, attrs=global_attrs)
+
+    # assign final attributes
+    for dim, values in concat_coords.items():
+        ds0[dim] = values
+    ds0["M"] = np.arange(ds0.sizes["M"]) + 1
+    ds0["L"] = np.arange(ds0.sizes["L"]) + 1
+
+    # reorder into desired format (Y,L,M,...)
+    ds0 = ds0.transpose("Y", "L", "M", ...)
+
+    return ds0
+
+
+def _direct_attrs(var):
+    """
+    Returns the attributes of a netCDF4 variable, without those consumed by
+    decoding (encoding, scaling and coordinates).
+    """
+
+    return {att: var.getncattr(att) for att in var.ncattrs()
+            if not att.startswith('_') and att not in
+            ('missing_value', 'scale_factor', 'add_offset', 'coordinates')}
+
+
+def _read_direct(file, field, key, dtype):
+    """
+    Reads the hyperslab key of field from one file, with missing values as NaN.
+    """
+
+    import netCDF4
+
+    with netCDF4.Dataset(file) as nc:
+        data = nc[field][key]
+
+    return np.ma.filled(np.ma.asarray(data, dtype=dtype), np.nan)
+
+
+def _open_processes(file_list, concat_coords, nlead, field, preproc, chunks, share_time,
+                    region, max_workers=None):
+    """
+    Reads and preprocesses a nested list of files for one field in worker
+    processes and returns it, loaded, in the (Y,L,M,...) layout of
+    get_monthly_data. The first file is processed here to size a shared
+    memory buffer, which the workers fill in place; chunks is not used.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    # every start year must hold the same number of members
+    nmem = set(_member_counts(file_list))
+    if len(nmem) > 1:
+        raise ValueError('ERROR: method processes requires the same number of members for '
+                         'every start year, found {}'.format(sorted(nmem)))
+    files = np.array(file_list, dtype=object)
+    read = partial(_preprocess_file, field=field, preproc=preproc, region=region,
+                   nlead=nlead, share_time=share_time)
+    template = read(files.flat[0])
+    var = template[field]
+    shape = files.shape + var.shape
+
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) *
+                                                           var.dtype.itemsize, 1))
+    try:
+        buf = np.ndarray(shape, dtype=var.dtype, buffer=shm.buf)
+        buf[(0,) * files.ndim] = var.values
+        del buf
+        indices = list(np.ndindex(files.shape))[1:]
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            times = list(pool.map(partial(_process_file, read=read, field=field,
+                                          shm_name=shm.name, shape=shape,
+                                          dtype=var.dtype.str),
+                                  indices, files.flat[1:]))
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    # the result is a view of the block, which stays mapped until it is released
+    shm.unlink()
+    data = np.asarray(_SharedArray(shm, shape, var.dtype))
+
+    # time only varies with the outer levels, so keep that of the first member
+    time = np.empty(files.shape[:-1] + (template.sizes["L"],), dtype=template.time.dtype)
+    for index, values in zip([(0,) * files.ndim] + indices, [template.time.values] + times):
+        if index[-1] == 0:
+            time[index[:-1]] = values.ravel()
+
+    concat_dims = list(concat_coords)
+    ds0 = xr.Dataset({field: (concat_dims + ["M"] + list(var.dims), data, var.attrs),
+                      "time": (concat_dims + ["L"], time)},
+                     coords={name: coord.variable for name, coord in var.coords.items()},
+                     attrs=template.attrs)
+    ds0["time"].attrs = template.time.attrs
+    if share_time:
+        ds0 = _decode_shared_time(ds0)
+
+    # assign final attributes
+    for dim, values in concat_coords.items():
+        ds0[dim] = values
+    ds0["M"] = np.arange(ds0.sizes["M"]) + 1
+
+    # reorder into desired format (Y,L,M,...)
+    ds0 = ds0.transpose("Y", "L", "M", ...)
+
+    return ds0
+
+
+def _member_counts(file_list):
+    """
+    Returns the number of member files of every start year in a nested file list.
+    """
+
+    if all(isinstance(ff, str) for ff in file_list):
+        return [len(file_list)]
+    return [count for ff in file_list for count in _member_counts(ff)]
+
+
+class _SharedArray:
+    """
+    Exposes a shared memory block as an array interface and closes the block
+    when the last array viewing it is released.
+    """
+
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # only the address is kept, so the block can be closed later
+        self.__array_interface__ = dict(view.__array_interface__)
+        del view
+
+    def __del__(self):
+        self.shm.close()
+
+
+def _preprocess_file(file, field, preproc, region, nlead, share_time):
+    """
+    Opens, subsets and preprocesses a single file, and loads the result.
+    """
+
+    import dask
+
+    with dask.config.set(scheduler='synchronous'):
+        with xr.open_dataset(file, decode_times=_decode_times(share_time)) as ds:
+            d0 = _subset_preprocess(ds, preproc=preproc, region=region,
+                                    share_time=share_time, nlead=nlead, field=field)
+            return d0[[field, 'time']].load()
+
+
+def _process_file(index, file, read, field, shm_name, shape, dtype):
+    """
+    Worker for _open_processes; writes one preprocessed file into the shared
+    buffer at index and returns its time values.
+    """
+
+    from multiprocessing import shared_memory
+
+    d0 = read(file)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        buf = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        buf[index] = d0[field].values
+    finally:
+        shm.close()
+
+    return d0.time.values
+
+
+def lead_chunks(file, field, nlead, chunks={}):
+    """
+    Returns the chunks with which timeseries files are opened so that the
+    first nlead time steps form a single dask chunk aligned with the
+    on-disk (HDF5) chunking of field. Only the chunks holding those lead
+    times are then read, and no rechunking along L is needed. Chunks
+    given explicitly for a dimension are kept.
+
+    Parameters
+    ----------
+    file : str
+        timeseries file whose layout is representative of the archive
+    field : str
+        variable to be examined, eg 'TREFHT'
+    nlead : int
+        number of months over which data is read
+    chunks : dict
+        chunks requested by the user, defaults to {}
+
+    Returns
+    -------
+    chunks : dict
+        chunks for opening the timeseries files
+    """
+
+    if not isinstance(chunks, dict) or 'time' in chunks:
+        return chunks
+
+    with xr.open_dataset(file, decode_times=False) as ds:
+        var = ds[field]
+        preferred = dict(var.encoding.get('preferred_chunks', {}))
+        ntime = ds.sizes['time']
+
+    # round nlead up to a whole number of on-disk time chunks
+    tchunk = preferred.pop('time', 1)
+    lead_chunk = min(int(np.ceil(nlead / tchunk)) * tchunk, ntime)
+    preferred.update(chunks)
+    preferred['time'] = lead_chunk
+
+    return preferred
+
+
+def subset_region(ds, region):
+    """
+    Returns ds restricted to a spatial region. The selection is lazy, so
+    only the corresponding hyperslab is read from disk.
+
+    Parameters
+    ----------
+    ds : xarray
+        xarray dataset with 1-D (eg CAM lon/lat) or 2-D (eg POP TLONG/TLAT)
+        longitude and latitude coordinates
+    region : dict or tuple
+        either a dictionary of index slices passed to isel, eg
+        {'nlat': slice(250, 350), 'nlon': slice(0, 100)}, or a bounding box
+        (lon_min, lon_max, lat_min, lat_max) in degrees. A box with
+        lon_min > lon_max wraps across longitude 0, eg (280, 20, 20, 80).
+
+    Returns
+    -------
+    ds : xarray
+        xarray dataset restricted to the region
+    """
+
+    if region is None:
+        return ds
+    if isinstance(region, dict):
+        return ds.isel(region)
+
+    lon_min, lon_max, lat_min, lat_max = region
+    lon = ds[_find_name(ds, _LON_NAMES)]
+    lat = ds[_find_name(ds, _LAT_NAMES)]
+
+    # flag points inside the box, allowing the box to wrap across 0
+    if lon_max - lon_min >= 360:
+        inlon = xr.ones_like(lon, dtype=bool)
+    else:
+        lonv = lon % 360
+        lon_min = lon_min % 360
+        lon_max = lon_max % 360
+        if lon_min <= lon_max:
+            inlon = (lonv >= lon_min) & (lonv <= lon_max)
+        else:
+            inlon = (lonv >= lon_min) | (lonv <= lon_max)
+    inlat = (lat >= lat_min) & (lat <= lat_max)
+
+    if lon.ndim == 1:
+        xdim, ydim = lon.dims[0], lat.dims[0]
+        xflags, yflags = inlon.values, inlat.values
+    else:
+        # curvilinear grid; select the index box enclosing the region
+        mask = (inlon & inlat).transpose(*lon.dims).values
+        ydim, xdim = lon.dims
+        xflags, yflags = mask.any(axis=0), mask.any(axis=1)
+
+    rows = np.flatnonzero(yflags)
+    if rows.size == 0 or not xflags.any():
+        raise ValueError('ERROR: no grid points found in region {}'.format(region))
+    ds = ds.isel({ydim: slice(rows[0], rows[-1] + 1)})
+
+    # read a box wrapping across the grid edge as two contiguous slabs
+    slices = _wrapped_slices(xflags)
+    if len(slices) == 1:
+        return ds.isel({xdim: slices[0]})
+    return xr.concat([ds.isel({xdim: sl}) for sl in slices], dim=xdim,
+                     data_vars='minimal', coords='minimal', compat='override')
+
+
+def _wrapped_slices(flags):
+    """
+    Returns the index slices covering the True values of a periodic 1-D
+    boolean array: one slice, or two when the run wraps across the end.
+    """
+
+    idx = np.flatnonzero(flags)
+    n = flags.size
+    if idx.size == n:
+        return [slice(0, n)]
+    # start the run after the largest gap of False values
+    gaps = np.diff(np.append(idx, idx[0] + n))
+    idx = np.roll(idx, -(np.argmax(gaps) + 1))
+    first, last = int(idx[0]), int(idx[-1])
+    if first <= last:
+        return [slice(first, last + 1)]
+    return [slice(first, n), slice(0, last + 1)]
+
+
+def _find_name(ds, names):
+    """
+    Returns the first of names found in ds.
+    """
+
+    for name in names:
+        if name in ds.variables:
+            return name
+    raise ValueError('ERROR: none of {} found in dataset'.format(names))
+
+
+def _decode_times(share_time):
     """
-    Returns a dask array containing the requested hindcast ensemble.
+    Returns the decode_times argument for opening files: with share_time,
+    only the time axis is left undecoded (see _decode_shared_time).
+    """
+
+    return {'time': False} if share_time else True
+
+
+def _decode_shared_time(ds0):
+    """
+    Decodes the raw numeric time axis of an assembled hindcast, shared by
+    all members of a start year, to mid-month dates in a single call, unless
+    preproc already decoded it.
+    """
+
+    time = ds0["time"]
+    if not np.issubdtype(time.dtype, np.number):
+        return ds0
+    attrs = {att: value for att, value in time.attrs.items()
+             if att not in ('units', 'calendar')}
+    newtime = midmonth_from_num(time.values, time.attrs['units'],
+                                time.attrs.get('calendar', 'standard'))
+    ds0["time"] = (time.dims, newtime, attrs)
+
+    return ds0
+
+
+def _subset_preprocess(ds0, preproc, region, share_time=False, **kwargs):
+    """
+    Applies subset_region to a file as it is opened, then preproc. With
+    share_time, raw numeric times are first converted to common units, so
+    that files with different reference dates share one decoding.
+    """
+
+    ds0 = subset_region(ds0, region)
+    if share_time and np.issubdtype(ds0['time'].dtype, np.number):
+        time = ds0['time']
+        offset, scale = _time_offset(time.attrs['units'], time.attrs.get('calendar', 'standard'))
+        attrs = dict(time.attrs, units=_NOLEAP_UNITS)
+        ds0 = ds0.assign_coords(time=('time', offset + time.values * scale, attrs))
+
+    return preproc(ds0, **kwargs)
+
+
+@lru_cache(maxsize=64)
+def _time_offset(units, calendar):
+    """
+    Returns the reference date of CF time units in days since 0001-01-01,
+    and the length of one unit in days.
+    """
+
+    offset = cftime.date2num(cftime.num2date(0, units, calendar=calendar),
+                             _NOLEAP_UNITS, calendar=calendar)
+
+    return float(offset), _UNITS_IN_DAYS[units.split(' since ')[0].strip().lower()]
+
+
+_LON_NAMES = ('lon', 'TLONG', 'ULONG', 'longitude')
+_LAT_NAMES = ('lat', 'TLAT', 'ULAT', 'latitude')
+
+
+def ingest_zarr(filetemplate, filetype, ens, nlead, field, start_years, stmon,
+                preproc, store, **kwargs):
+    """
+    Materializes the hindcast ensemble returned by get_monthly_data into a
+    chunked, compressed Zarr store laid out (Y,L,M,...), with one chunk per
+    start year. If the store already exists, only start years that are not
+    yet in it are read, and they are appended along Y without rewriting the
+    existing chunks. Requires zarr.
 
     Parameters
     ----------
-    nfiletemplate : str
+    filetemplate : str
         file template
     filetype : str
         file ending
     ens : int
         ensemble member
     nlead : int
-        number of months over which data is read; allows for a partial read
-        of the data and controls the time dimension of returned dask array
+        number of months over which data is read
     field : str
         variable to be examined, eg 'TREFHT'
-    startyears : list
+    start_years : list
         list of start years which are integers
     stmon : str
         month
     preproc : func
         preprocessing function
+    store : str
+        path of the Zarr store
+    **kwargs
+        further keyword arguments passed to get_monthly_data
+
+    Returns
+    -------
+    new_years : list
+        start years that were written to the store
+    """
+
+    if os.path.exists(store):
+        existing = xr.open_zarr(store).Y.values
+        start_years = [yy for yy in start_years if yy not in existing]
+        if not start_years:
+            return []
+        mode = {'append_dim': 'Y'}
+    else:
+        mode = {'mode': 'w-'}
+
+    ds0 = get_monthly_data(filetemplate, filetype, ens, nlead, field,
+                           start_years, stmon, preproc, **kwargs)
+    new_years = [int(yy) for yy in ds0.Y.values]
+
+    # one chunk per start year; drop the on-disk NetCDF encoding
+    ds0 = ds0.chunk({'Y': 1, 'L': -1, 'M': -1})
+    for var in ds0.variables.values():
+        var.encoding = {}
+    if 'append_dim' in mode:
+        # variables without a Y dimension are already in the store
+        ds0 = ds0.drop_vars([name for name in ds0.variables if 'Y' not in ds0[name].dims])
+
+    ds0.to_zarr(store, **mode)
+
+    return new_years
+
+
+def open_zarr_store(store, start_years=None):
+    """
+    Returns a dask array containing the hindcast ensemble in a Zarr store
+    written by ingest_zarr, ordered by start year.
+
+    Parameters
+    ----------
+    store : str
+        path of the Zarr store
+    start_years : list (optional)
+        list of start years which are integers; all years if None
+
+    Returns
+    -------
+    ds0 : dask array
+        dask array containing requested hindcast ensemble
+    """
+
+    ds0 = xr.open_zarr(store).sortby('Y')
+    if start_years is not None:
+        ds0 = ds0.sel(Y=[yy for yy in start_years if yy in ds0.Y.values])
+
+    return ds0
+
+
+def build_references(file_list, yrs, reffile):
+    """
+    Scans the HDF5 chunk layout of each timeseries file once and writes a
+    kerchunk reference set (JSON) describing the whole hindcast as a single
+    virtual Zarr store with dimensions (Y,M,time,...). The store can then be
+    opened with open_references, or get_monthly_data(references=...),
+    without opening the individual files. Requires kerchunk, fsspec and h5py.
+
+    Parameters
+    ----------
+    file_list : list
+        nested list of files (dim0=start year, dim1=ens), as returned by
+        nested_file_list_by_year
+    yrs : list
+        start years of file_list, as returned by nested_file_list_by_year
+    reffile : str
+        path of the JSON reference file to write
+
+    Returns
+    -------
+    refs : dict
+        kerchunk references that were written to reffile
+    """
+
+    try:
+        import fsspec
+        import h5py
+        from kerchunk.combine import MultiZarrToZarr
+        from kerchunk.hdf import SingleHdf5ToZarr
+    except ImportError:
+        raise ImportError('ERROR: build_references requires kerchunk, fsspec and h5py')
+
+    single_refs = []
+    year_coords = []
+    mem_coords = []
+    times = []
+    for yy, ffs in zip(yrs, file_list):
+        for i, file in enumerate(ffs):
+            with fsspec.open(file) as fh:
+                single_refs.append(SingleHdf5ToZarr(fh, file, inline_threshold=0).translate())
+                # keep the raw time axis of one member per start year
+                if i == 0:
+                    with h5py.File(fh, 'r') as h5:
+                        times.append(h5['time'][:].astype(np.float64))
+                        tattrs = {key: _h5_attr(h5['time'].attrs[key])
+                                  for key in ('units', 'calendar') if key in h5['time'].attrs}
+            year_coords.append(yy)
+            mem_coords.append(i + 1)
+
+    # variables without a time dimension are shared by all files
+    with fsspec.open(file_list[0][0]) as fh, h5py.File(fh, 'r') as h5:
+        identical = [name for name, var in h5.items()
+                     if isinstance(var, h5py.Dataset) and 'time' not in _h5_dims(var)]
+
+    mzz = MultiZarrToZarr(single_refs, concat_dims=['Y', 'M'],
+                          coo_map={'Y': year_coords, 'M': mem_coords},
+                          identical_dims=identical)
+    refs = mzz.translate()
+
+    # add the time axis of every start year as a (Y,time) variable
+    hindcast_time = np.stack(times)
+    refs['refs']['hindcast_time/.zarray'] = json.dumps({
+        'chunks': list(hindcast_time.shape), 'compressor': None, 'dtype': '<f8',
+        'fill_value': None, 'filters': None, 'order': 'C',
+        'shape': list(hindcast_time.shape), 'zarr_format': 2})
+    refs['refs']['hindcast_time/.zattrs'] = json.dumps(dict(tattrs, _ARRAY_DIMENSIONS=['Y', 'time']))
+    refs['refs']['hindcast_time/0.0'] = 'base64:' + base64.b64encode(
+        hindcast_time.astype('<f8').tobytes()).decode()
+
+    with open(reffile, 'w') as f:
+        json.dump(refs, f)
+
+    return refs
+
+
+def open_references(reffile, field, nlead, start_years=None, chunks={}):
+    """
+    Returns a dask array containing the hindcast ensemble described by a
+    reference file written by build_references, in the same (Y,L,M,...)
+    layout and with the same mid-month time coordinate as get_monthly_data.
+
+    Parameters
+    ----------
+    reffile : str
+        path of the JSON reference file
+    field : str or list
+        variable (or list of variables) to be examined, eg 'TREFHT'
+    nlead : int
+        number of months over which data is read
+    start_years : list (optional)
+        list of start years which are integers; all years if None
     chunks : dict
         chunks for dask array, defaults to {}
 
@@ -105,29 +1564,23 @@ def get_monthly_data(filetemplate, filetype, ens, nlead, field,
         dask array containing requested hindcast ensemble
     """
 
-    # Retrieve nested list of files
-    file_list, yrs = nested_file_list_by_year(filetemplate, filetype, ens,
-                                              start_years, stmon)
+    ds = xr.open_dataset('reference://', engine='zarr', decode_times=False,
+                         backend_kwargs={'consolidated': False,
+                                         'storage_options': {'fo': reffile}},
+                         chunks=chunks)
+    if start_years is not None:
+        ds = ds.sel(Y=[yy for yy in start_years if yy in ds.Y.values])
+    ds = ds.isel(time=slice(0, nlead))
 
-    # open xarray dataset, passing in parameters including preprocessing fxn
-    ds0 = xr.open_mfdataset(file_list,
-                            combine="nested",
-                            # concat_dim depends on how file_list is ordered;
-                            # inner most list of datasets is combined along "M"
-                            # then the outer list is combined along "Y"
-                            concat_dim=["Y", "M"],
-                            parallel=True,
-                            data_vars=[field],
-                            coords="minimal",
-                            compat="override",
-                            preprocess=partial(preproc,
-                                               nlead=nlead,
-                                               field=field),
-                            chunks=chunks)
+    # mid-month time of every start year and lead
+    htime = ds['hindcast_time']
+    newtime = midmonth_from_num(htime.values, htime.attrs['units'],
+                                htime.attrs.get('calendar', 'standard'))
 
-    # assign final attributes
-    ds0["Y"] = start_years
-    ds0["M"] = np.arange(ds0.sizes["M"]) + 1
+    fields = [field] if isinstance(field, str) else list(field)
+    ds0 = ds[fields].drop_vars('time', errors='ignore').rename({'time': 'L'})
+    ds0 = ds0.assign_coords(L=np.arange(ds0.sizes['L']) + 1)
+    ds0['time'] = (('Y', 'L'), newtime)
 
     # reorder into desired format (Y,L,M,...)
     ds0 = ds0.transpose("Y", "L", "M", ...)
@@ -135,7 +1588,26 @@ def get_monthly_data(filetemplate, filetype, ens, nlead, field,
     return ds0
 
 
-def nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon):
+def _h5_attr(value):
+    """
+    Converts an HDF5 attribute value to a str.
+    """
+
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
+
+
+def _h5_dims(var):
+    """
+    Returns the dimension names of a netCDF4 variable read with h5py.
+    """
+
+    return [dim[0].name.split('/')[-1] if len(dim) else '' for dim in var.dims]
+
+
+def nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon, index=None,
+                             catalog=None, nthreads=None, field=None):
     """
     Retrieves a nested list of files for these start years and ensemble members
 
@@ -151,6 +1623,16 @@ def nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon):
         list of start years which are integers
     stmon : str
         month
+    index : dict (optional)
+        file index returned by file_index; scanned from filetemplate if None
+    catalog : str (optional)
+        SQLite catalog written by build_catalog; queried instead of
+        scanning the archive if no index is given
+    nthreads : int (optional)
+        number of threads used to list the archive (see file_index)
+    field : str (optional)
+        only return files of this field, for templates matching several
+        fields; defaults to None (no filtering)
 
     Returns
     -------
@@ -164,13 +1646,19 @@ def nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon):
     filecount = []
     yrs_final = []
 
+    # scan the archive once and look up filepaths for each member
+    if index is None and catalog is not None:
+        index = catalog_index(catalog, filetemplate)
+    elif index is None:
+        index = file_index(filetemplate, filetype, nthreads=nthreads)
+    memfiles = [_index_filepaths(index, ee, int(stmon), field=field) for ee in ens]
+
     # loop through all years and ensemble members to retrieve filepaths
     for yy, i in zip(yrs, range(len(yrs))):
         ffs = []  # a list of files for this yy
         file0 = ''
         first = True
-        for ee in ens:
-            filepaths = file_dict(filetemplate, filetype, ee, stmon)
+        for filepaths in memfiles:
             # append file if it is new
             if yy in filepaths.keys():
                 file = filepaths[yy]
@@ -191,7 +1679,274 @@ def nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon):
     return nested_files
 
 
-def preprocessor(ds0, nlead, field):
+def region_weights(lon, lat, regions, area=None, mask=None):
+    """
+    Precomputes a sparse (region x gridcell) area-weight matrix with which
+    apply_weights reduces a field to the area-weighted means of many
+    regions in a single sparse matrix multiply.
+
+    Parameters
+    ----------
+    lon : DataArray
+        longitudes, either 1-D (eg CAM lon) or 2-D (eg POP TLONG)
+    lat : DataArray
+        latitudes, either 1-D (eg CAM lat) or 2-D (eg POP TLAT)
+    regions : dict
+        regions keyed by name. Each region is either a box
+        (lon_min, lon_max, lat_min, lat_max), which wraps across longitude 0
+        if lon_min > lon_max, or a polygon given as a list of (lon, lat)
+        vertices in the longitude convention of the grid.
+    area : DataArray (optional)
+        grid cell areas, eg POP TAREA; defaults to cos(lat)
+    mask : DataArray (optional)
+        grid cells to include, eg POP REGION_MASK > 0; defaults to all
+
+    Returns
+    -------
+    weights : SparseWeights
+        sparse weights mapping the grid to the 'region' dimension
+    """
+
+    from scipy import sparse
+
+    if lon.ndim == 1:
+        lat, lon = xr.broadcast(lat, lon)
+    in_dims = lon.dims
+    lonv = lon.values.ravel()
+    latv = lat.transpose(*in_dims).values.ravel()
+
+    if area is None:
+        area = np.cos(np.deg2rad(latv))
+    else:
+        area = area.transpose(*in_dims).values.ravel()
+    if mask is not None:
+        area = area * mask.transpose(*in_dims).values.ravel()
+    area = np.where(np.isnan(area), 0., area)
+
+    rows = []
+    for region in regions.values():
+        if np.ndim(region[0]) == 0:
+            inside = _in_box(lonv, latv, *region)
+        else:
+            inside = _in_polygon(lonv, latv, np.asarray(region, dtype=np.float64))
+        rows.append(sparse.csr_matrix(np.where(inside, area, 0.)))
+    matrix = sparse.vstack(rows).tocsr()
+
+    return SparseWeights(matrix, in_dims, ('region',), {'region': list(regions)})
+
+
+def apply_weights(ds, weights):
+    """
+    Applies sparse weights (eg from region_weights) to every variable of ds
+    containing the input dimensions of the weights. Missing values are
+    skipped, as in xarray's weighted mean. Works lazily on dask arrays, so
+    it can be used inside a preprocessor (see preprocessor).
+
+    Parameters
+    ----------
+    ds : xarray
+        Dataset or DataArray on the source grid
+    weights : SparseWeights
+        sparse weights, eg from region_weights
+
+    Returns
+    -------
+    ds : xarray
+        Dataset or DataArray on the output dimensions of the weights
+    """
+
+    if isinstance(ds, xr.Dataset):
+        return ds.map(lambda da: apply_weights(da, weights)
+                      if set(weights.in_dims) <= set(da.dims) else da, keep_attrs=True)
+
+    out_sizes = {dim: len(weights.out_coords[dim]) for dim in weights.out_dims}
+    da = xr.apply_ufunc(_apply_sparse, ds,
+                        input_core_dims=[list(weights.in_dims)],
+                        output_core_dims=[list(weights.out_dims)],
+                        exclude_dims=set(weights.in_dims) & set(weights.out_dims),
+                        kwargs={'matrix': weights.matrix,
+                                'ncore': len(weights.in_dims),
+                                'out_shape': tuple(out_sizes.values())},
+                        dask='parallelized',
+                        output_dtypes=[np.float64],
+                        dask_gufunc_kwargs={'output_sizes': out_sizes,
+                                            'allow_rechunk': True},
+                        keep_attrs=True)
+
+    return da.assign_coords(weights.out_coords)
+
+
+def regrid_weights(src_lon, src_lat, dst_lon, dst_lat, area=None, cache_dir=None):
+    """
+    Builds (or loads from cache) sparse conservative regridding weights
+    from a source grid to a regular destination lon/lat grid. The weights
+    are applied with apply_weights, eg per file in the preprocessor, so
+    only the regridded data enters the dask graph.
+
+    For a rectilinear source grid (1-D lon/lat, eg CAM) the weights are the
+    exact cell overlap areas. For a curvilinear source grid (2-D lon/lat,
+    eg POP) each source cell is assigned, with its area, to the destination
+    cell containing its centre, which is conservative when the destination
+    grid is much coarser than the source (eg 1 to 5 degrees).
+
+    Parameters
+    ----------
+    src_lon : DataArray
+        source longitudes, 1-D or 2-D (cell centres)
+    src_lat : DataArray
+        source latitudes, 1-D or 2-D (cell centres)
+    dst_lon : array
+        destination longitudes (regularly spaced cell centres)
+    dst_lat : array
+        destination latitudes (regularly spaced cell centres)
+    area : DataArray (optional)
+        source cell areas for curvilinear grids, eg POP TAREA; defaults to
+        cos(lat)
+    cache_dir : str (optional)
+        directory in which weights are stored as sparse matrices keyed by a
+        hash of the source and destination grids, and reused if present
+
+    Returns
+    -------
+    weights : SparseWeights
+        sparse weights mapping the source grid to ('lat','lon')
+    """
+
+    from scipy import sparse
+
+    dst_lon = np.asarray(dst_lon, dtype=np.float64)
+    dst_lat = np.asarray(dst_lat, dtype=np.float64)
+    in_dims = (src_lat.dims[0], src_lon.dims[0]) if src_lon.ndim == 1 else src_lon.dims
+    out_coords = {'lat': dst_lat, 'lon': dst_lon}
+
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        for arr in (src_lon.values, src_lat.values, dst_lon, dst_lat):
+            key.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        if area is not None:
+            key.update(np.ascontiguousarray(area.values, dtype=np.float64).tobytes())
+        cache_file = os.path.join(cache_dir, 'regrid_{}.npz'.format(key.hexdigest()))
+        if os.path.exists(cache_file):
+            return SparseWeights(sparse.load_npz(cache_file), in_dims, ('lat', 'lon'),
+                                 out_coords)
+
+    dlon_edges = _cell_edges(dst_lon)
+    dlat_edges = np.clip(_cell_edges(dst_lat), -90., 90.)
+
+    if src_lon.ndim == 1:
+        # exact overlaps, separable in sin(lat) and lon
+        slat_edges = np.clip(_cell_edges(src_lat.values), -90., 90.)
+        wlat = _overlap(np.sin(np.deg2rad(dlat_edges)), np.sin(np.deg2rad(slat_edges)))
+        wlon = _overlap(dlon_edges, _cell_edges(src_lon.values), period=360.)
+        matrix = sparse.kron(sparse.csr_matrix(wlat), sparse.csr_matrix(wlon))
+    else:
+        lonv = src_lon.values.ravel()
+        latv = src_lat.transpose(*in_dims).values.ravel()
+        if area is None:
+            areav = np.cos(np.deg2rad(latv))
+        else:
+            areav = area.transpose(*in_dims).values.ravel()
+        # destination cell containing each source cell centre
+        ilat = np.searchsorted(dlat_edges, latv) - 1
+        ilon = np.searchsorted(dlon_edges, (lonv - dlon_edges[0]) % 360. + dlon_edges[0]) - 1
+        ok = (ilat >= 0) & (ilat < dst_lat.size) & (ilon >= 0) & (ilon < dst_lon.size)
+        ok &= np.isfinite(areav)
+        matrix = sparse.coo_matrix((areav[ok], (ilat[ok] * dst_lon.size + ilon[ok],
+                                                np.flatnonzero(ok))),
+                                   shape=(dst_lat.size * dst_lon.size, lonv.size))
+    matrix = matrix.tocsr()
+    matrix.eliminate_zeros()
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        sparse.save_npz(cache_file, matrix)
+
+    return SparseWeights(matrix, in_dims, ('lat', 'lon'), out_coords)
+
+
+def _cell_edges(centres):
+    """
+    Returns the n+1 cell edges of n cell centres, half way between centres.
+    """
+
+    centres = np.asarray(centres, dtype=np.float64)
+    mid = 0.5 * (centres[1:] + centres[:-1])
+
+    return np.concatenate([[2 * centres[0] - mid[0]], mid, [2 * centres[-1] - mid[-1]]])
+
+
+def _overlap(dst_edges, src_edges, period=None):
+    """
+    Returns the (dst x src) matrix of overlap lengths between the cells of
+    two sets of 1-D edges, optionally periodic.
+    """
+
+    d0, d1 = dst_edges[:-1, None], dst_edges[1:, None]
+    s0, s1 = src_edges[None, :-1], src_edges[None, 1:]
+    shifts = [0.] if period is None else [-period, 0., period]
+
+    return sum(np.clip(np.minimum(d1, s1 + k) - np.maximum(d0, s0 + k), 0., None)
+               for k in shifts)
+
+
+def _apply_sparse(x, matrix, ncore, out_shape):
+    """
+    Weighted sums of x over its ncore trailing (gridcell) dimensions,
+    normalized by the weights of the valid values.
+    """
+
+    lead_shape = x.shape[:x.ndim - ncore]
+    x2 = x.reshape(-1, matrix.shape[1])
+    valid = ~np.isnan(x2)
+    num = matrix.dot(np.where(valid, x2, 0.).T).T
+    den = matrix.dot(valid.T.astype(np.float64)).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = num / den
+
+    return out.reshape(lead_shape + out_shape)
+
+
+def _in_box(lon, lat, lon_min, lon_max, lat_min, lat_max):
+    """
+    Flags points inside a lon/lat box, which may wrap across longitude 0.
+    """
+
+    inlat = (lat >= lat_min) & (lat <= lat_max)
+    if lon_max - lon_min >= 360:
+        return inlat
+    lon = lon % 360
+    lon_min = lon_min % 360
+    lon_max = lon_max % 360
+    if lon_min <= lon_max:
+        return inlat & (lon >= lon_min) & (lon <= lon_max)
+    return inlat & ((lon >= lon_min) | (lon <= lon_max))
+
+
+def _in_polygon(lon, lat, vertices):
+    """
+    Flags points inside a polygon with the even-odd (ray casting) rule.
+    """
+
+    inside = np.zeros(lon.shape, dtype=bool)
+    x0, y0 = vertices[-1]
+    for x1, y1 in vertices:
+        crosses = (y1 > lat) != (y0 > lat)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            xcross = x1 + (lat - y1) * (x0 - x1) / (y0 - y1)
+        inside ^= crosses & (lon < xcross)
+        x0, y0 = x1, y1
+
+    return inside
+
+
+SparseWeights = namedtuple('SparseWeights', ['matrix', 'in_dims', 'out_dims', 'out_coords'])
+SparseWeights.__doc__ = """
+Sparse weights mapping the grid cells along in_dims (flattened in C
+order) to the points along out_dims, with coordinates out_coords.
+"""
+
+
+def preprocessor(ds0, nlead, field, freq=None, weights=None):
     """
     This preprocessor is applied on an individual timeseries file basis.
     It will return a monthly mean CAM field with centered time coordinate.
@@ -206,6 +1961,12 @@ def preprocessor(ds0, nlead, field):
         of the data and controls the time dimension of returned dask array
     field : str
         variable to be examined, eg 'TREFHT'
+    freq : str (optional)
+        if 'season' or 'annual', the field is averaged to seasonal or annual
+        means along L with seasonal_mean; defaults to None (monthly means)
+    weights : SparseWeights (optional)
+        sparse weights (eg from region_weights) applied to the field with
+        apply_weights; defaults to None
 
     Returns
     -------
@@ -213,23 +1974,137 @@ def preprocessor(ds0, nlead, field):
         xarray dataset of monthly mean CAM field with centered time coordinate
     """
 
-    # set the time to the 15th of the month instead of end of month
-    d0 = time_set_midmonth(ds0, 'time')
     # select time slice
-    d0 = d0.isel(time=slice(0, nlead))
+    d0 = ds0.isel(time=slice(0, nlead))
+    # set the time to the 15th of the month instead of end of month; a raw
+    # numeric time (share_time) is decoded once by get_monthly_data instead
+    if freq is not None or not np.issubdtype(d0.time.dtype, np.number):
+        d0 = time_set_midmonth(d0, 'time')
     # assign longitude, latitude, and time coordinates
-    d0 = d0.assign_coords({"lon": ds0.lon, "lat": ds0.lat})
+    d0 = d0.assign_coords({name: ds0[name] for name in ("lon", "lat") if name in ds0})
     d0 = d0.assign_coords(L=("time", np.arange(d0.sizes["time"])+1))
     # swap time and L 'temporary' dimensions
     d0 = d0.swap_dims({"time": "L"})
     d0 = d0.reset_coords(["time"])
     d0["time"] = d0.time.expand_dims("Y")
     d0 = d0[[field, 'time']]
+    # reduce the grid with precomputed sparse weights
+    if weights is not None:
+        d0 = apply_weights(d0, weights)
+    # average to seasonal or annual means
+    if freq is not None:
+        d0 = seasonal_mean(d0, freq=freq)
     # break xarray into chunks
     d0 = d0.chunk({'L': -1})
     return d0
 
 
+def seasonal_mean(ds, freq='season', time=None):
+    """
+    Averages monthly hindcast data along the lead dimension L to seasonal
+    (DJF, MAM, JJA, SON) or annual (Jan-Dec) means, weighted by the number
+    of days in each month. Leads before the first complete season or year,
+    and after the last one, are dropped. The average is computed as a
+    reshape of L followed by a weighted sum, so it can be applied inside a
+    preprocessor or to the (Y,L,M,...) output of get_monthly_data. If the
+    month sequence differs along another dimension (eg the start month S),
+    each start month is averaged separately.
+
+    Parameters
+    ----------
+    ds : xarray
+        Dataset with an L dimension and a mid-month time variable
+        dimensioned (...,L), eg the output of get_monthly_data, or a
+        DataArray together with time
+    freq : str (optional)
+        'season' (default) or 'annual'
+    time : DataArray (optional)
+        mid-month time dimensioned (...,L); defaults to ds['time']
+
+    Returns
+    -------
+    ds : xarray
+        seasonally or annually averaged data. For seasons, L is labelled by
+        the lead of the middle month and time is the time of the middle
+        month; for years, L counts the years from 1 and time is the year.
+    """
+
+    if time is None:
+        time = ds['time']
+    if freq == 'season':
+        width, first = 3, (12, 3, 6, 9)
+    elif freq == 'annual':
+        width, first = 12, (1,)
+    else:
+        raise ValueError('ERROR: freq must be either season or annual')
+
+    # the month sequence is the same for every start year, but may differ
+    # along other dimensions of time, eg the start month S
+    tvals = time.transpose('L', ...).values.reshape(time.sizes['L'], -1)
+    months = np.array([[tt.month for tt in row] for row in tvals]).reshape(tvals.shape)
+    if (months != months[:, :1]).any():
+        return _seasonal_mean_split(ds, freq, time)
+    months = months[:, 0]
+    starts = np.flatnonzero(np.isin(months, first))
+    nper = (months.size - starts[0]) // width if starts.size else 0
+    if nper == 0:
+        raise ValueError('ERROR: no complete {} within the leads provided'.format(freq))
+    lsel = slice(starts[0], starts[0] + nper * width)
+
+    # normalized days-in-month weights, dimensioned (L,month)
+    dpm = _DPM_NOLEAP[months[lsel] - 1].reshape(nper, width).astype(np.float64)
+    weights = xr.DataArray(dpm / dpm.sum(axis=1, keepdims=True), dims=('L', 'month'))
+
+    if freq == 'season':
+        centre = np.arange(starts[0] + 1, starts[0] + nper * width, width)
+        lvals = time['L'].values[centre] if 'L' in time.coords else centre + 1
+        newtime = time.isel(L=centre)
+    else:
+        lvals = np.arange(nper) + 1
+        newtime = time.isel(L=np.arange(starts[0], starts[0] + nper * width, width)).dt.year
+
+    def _average(da):
+        da = da.drop_vars('L', errors='ignore').isel(L=lsel)
+        da = da.coarsen(L=width).construct(L=('L', 'month'))
+        wgt = weights.astype(da.dtype) if np.issubdtype(da.dtype, np.floating) else weights
+        return (da * wgt).sum('month', skipna=False, keep_attrs=True)
+
+    if isinstance(ds, xr.DataArray):
+        return _average(ds).assign_coords(L=lvals)
+
+    averaged = {name: _average(da) for name, da in ds.data_vars.items()
+                if 'L' in da.dims and name != time.name}
+    ds = ds.drop_dims('L').assign(averaged)
+    ds[time.name] = newtime.drop_vars('L', errors='ignore')
+
+    return ds.assign_coords(L=lvals)
+
+
+def _seasonal_mean_split(ds, freq, time):
+    """
+    Applies seasonal_mean separately along the first non-Y dimension of time
+    (eg S) and concatenates the results, truncated to the common number of
+    seasons or years.
+    """
+
+    split = [dim for dim in time.dims if dim not in ('Y', 'L') and time.sizes[dim] > 1]
+    if not split:
+        raise ValueError('ERROR: the month sequence of time varies between start years')
+    dim = split[0]
+
+    parts = [seasonal_mean(ds.isel({dim: slice(i, i + 1)}), freq=freq,
+                           time=time.isel({dim: slice(i, i + 1)}))
+             for i in range(time.sizes[dim])]
+    nper = min(part.sizes['L'] for part in parts)
+    parts = [part.isel(L=slice(0, nper)) for part in parts]
+    if any((part['L'].values != parts[0]['L'].values).any() for part in parts):
+        raise ValueError('ERROR: the {}s along {} do not fall at common leads'.format(freq, dim))
+
+    if isinstance(ds, xr.DataArray):
+        return xr.concat(parts, dim)
+    return xr.concat(parts, dim, data_vars='minimal', coords='minimal', compat='override')
+
+
 def time_set_midmonth(ds, time_name):
     """
     Return copy of ds with values of ds[time_name] replaced with mid-month
@@ -239,7 +2114,8 @@ def time_set_midmonth(ds, time_name):
     ----------
     ds : xarray
         xarray dataset which currently has end month values
-        that will be replaced with mid month values
+        that will be replaced with mid month values; the time may be
+        decoded or raw numeric values with units and calendar attributes
     time_name : str
         name of time component, eg 'time'
 
@@ -250,13 +2126,121 @@ def time_set_midmonth(ds, time_name):
     """
 
     # retrieve current time
-    year = ds[time_name].dt.year
-    month = ds[time_name].dt.month
-    year = xr.where(month == 1, year-1, year)
-    month = xr.where(month == 1, 12, month-1)
-    nmonths = len(month)
+    time = ds[time_name]
+    if np.issubdtype(time.dtype, np.number):
+        newtime = midmonth_from_num(time.values, time.attrs['units'],
+                                    time.attrs.get('calendar', 'standard'))
+    elif time.dt.calendar in _NOLEAP_CALENDARS:
+        days = cftime.date2num(time.values, _NOLEAP_UNITS, calendar='noleap')
+        newtime = midmonth_from_num(days, _NOLEAP_UNITS)
+    else:
+        newtime = midmonth_from_yearmonth(time.dt.year.values, time.dt.month.values)
     # set time to 15th day of month
-    newtime = [cftime.DatetimeNoLeap(year[i], month[i], 15) for i in range(nmonths)]
-    ds[time_name] = newtime
+    ds[time_name] = (time.dims, newtime)
 
     return ds
+
+
+def midmonth_from_yearmonth(year, month):
+    """
+    Returns mid-month (day=15) cftime.DatetimeNoLeap dates for the months
+    preceding the given years and months, ie the months averaged by
+    end-month time stamps. Results are cached for repeated time axes.
+
+    Parameters
+    ----------
+    year : array
+        integer years of the end-month time stamps
+    month : array
+        integer months of the end-month time stamps
+
+    Returns
+    -------
+    newtime : array
+        array of cftime.DatetimeNoLeap, shaped like year
+    """
+
+    year = np.asarray(year, dtype=np.int64)
+    month = np.asarray(month, dtype=np.int64)
+    newtime = _midmonth_yearmonth(year.tobytes(), month.tobytes())
+
+    return newtime.reshape(year.shape).copy()
+
+
+def midmonth_from_num(values, units, calendar='noleap'):
+    """
+    Returns mid-month (day=15) cftime.DatetimeNoLeap dates for the months
+    preceding raw numeric end-month time values, as stored on disk.
+    For the noleap calendar the months are found arithmetically, without
+    decoding individual dates. Results are cached for repeated time axes.
+
+    Parameters
+    ----------
+    values : array
+        numeric time values
+    units : str
+        CF time units, eg 'days since 0000-01-01 00:00:00'
+    calendar : str (optional)
+        CF calendar, defaults to 'noleap'
+
+    Returns
+    -------
+    newtime : array
+        array of cftime.DatetimeNoLeap, shaped like values
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    if calendar in _NOLEAP_CALENDARS:
+        newtime = _midmonth_num(values.tobytes(), units, calendar)
+        return newtime.reshape(values.shape).copy()
+
+    # other calendars are decoded in bulk
+    dates = cftime.num2date(values.ravel(), units, calendar=calendar)
+    year = [date.year for date in dates]
+    month = [date.month for date in dates]
+
+    return midmonth_from_yearmonth(year, month).reshape(values.shape)
+
+
+@lru_cache(maxsize=256)
+def _midmonth_yearmonth(ybytes, mbytes):
+    """
+    Cached worker for midmonth_from_yearmonth.
+    """
+
+    year = np.frombuffer(ybytes, dtype=np.int64)
+    month = np.frombuffer(mbytes, dtype=np.int64)
+    # shift end-month time stamps back to the month they average
+    year = np.where(month == 1, year - 1, year)
+    month = np.where(month == 1, 12, month - 1)
+    days = (year - 1) * 365 + _DOY_NOLEAP[month - 1] + 14
+
+    return cftime.num2date(days, _NOLEAP_UNITS, calendar='noleap')
+
+
+@lru_cache(maxsize=256)
+def _midmonth_num(vbytes, units, calendar):
+    """
+    Cached worker for midmonth_from_num on noleap calendars.
+    """
+
+    values = np.frombuffer(vbytes, dtype=np.float64)
+    # convert values to days since 0001-01-01 with a linear transform
+    d0 = cftime.date2num(cftime.num2date(0, units, calendar=calendar),
+                         _NOLEAP_UNITS, calendar=calendar)
+    scale = _UNITS_IN_DAYS[units.split(' since ')[0].strip().lower()]
+    days = np.floor(d0 + values * scale + 1e-6).astype(np.int64)
+    year = days // 365 + 1
+    month = np.searchsorted(_DOY_NOLEAP, days % 365, side='right')
+
+    return _midmonth_yearmonth(year.tobytes(), month.astype(np.int64).tobytes())
+
+
+# day of year (zero based) at the start of each month of the noleap calendar
+_DOY_NOLEAP = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334])
+_DPM_NOLEAP = np.diff(np.append(_DOY_NOLEAP, 365))
+_NOLEAP_CALENDARS = ('noleap', '365_day')
+_NOLEAP_UNITS = 'days since 0001-01-01 00:00:00'
+_UNITS_IN_DAYS = {'days': 1., 'hours': 1. / 24., 'minutes': 1. / 1440.,
+                  'seconds': 1. / 86400., 'milliseconds': 1. / 86400e3,
+                  'microseconds': 1. / 86400e6}
@@ -20,7 +20,7 @@ Use
 Dependencies
 ------------
     The user must have an activated conda environment which includes
-    xarray, numpy, sys, cftime, and xskillscore.
+    xarray, numpy, scipy, sys, cftime, and xskillscore.
 """
 
 import xarray as xr
@@ -28,6 +28,11 @@ import numpy as np
 import sys
 import cftime
 import xskillscore as xs
+from scipy import special
+
+
+# metrics returned by skill_kernel, in order
+SKILL_METRICS = ('corr', 'pval', 'rmse', 'msss', 'rpc', 'sig_obs', 'sig_sig', 'sig_tot', 's2t')
 
 
 def cor_ci_bootyears(ts1, ts2, seed=None, nboots=1000, conf=95):
@@ -114,7 +119,53 @@ def detrend_linear(dat, dim):
     return dat
 
 
-def leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=False):
+def align_obs(mod_time, obs_da, time_dim='time'):
+    """
+    Gathers a monthly (or seasonal, one value per season centre month)
+    OBS DataArray onto the (Y,L) verification times of a hindcast, with a
+    single vectorized integer-index selection. Verification times outside
+    the OBS record are masked.
+
+    Parameters
+    ----------
+    mod_time : DataArray
+        a hindcast time DataArray dimensioned (Y,L). Assumes mod_time.dt.month
+        & mod_time.dt.year exist.
+    obs_da : DataArray
+        an OBS DataArray dimensioned (time,...)
+    time_dim : str (optional)
+        name of the OBS time dimension; defaults to 'time'
+
+    Returns
+    -------
+    obs_yl : DataArray
+        OBS DataArray dimensioned (Y,L,...), NaN where not available
+    valid : DataArray
+        boolean DataArray dimensioned (Y,L), True where the verification
+        time is within the OBS record
+    """
+
+    # months since year 0 for hindcast and OBS times
+    mod_month = np.asarray(mod_time.dt.year * 12 + mod_time.dt.month - 1)
+    obs_month = np.asarray(obs_da[time_dim].dt.year * 12 + obs_da[time_dim].dt.month - 1)
+
+    # lookup table from month to OBS position, -1 where missing
+    first = obs_month.min()
+    lookup = np.full(obs_month.max() - first + 1, -1)
+    lookup[obs_month - first] = np.arange(obs_month.size)
+    offset = mod_month - first
+    inside = (offset >= 0) & (offset < lookup.size)
+    pos = np.where(inside, lookup[np.clip(offset, 0, lookup.size - 1)], -1)
+
+    valid = xr.DataArray(pos >= 0, dims=mod_time.dims, coords=mod_time.coords)
+    index = xr.DataArray(np.maximum(pos, 0), dims=mod_time.dims)
+    obs_yl = obs_da.isel({time_dim: index}).drop_vars(time_dim)
+    obs_yl = obs_yl.assign_coords(mod_time.coords).where(valid)
+
+    return obs_yl, valid
+
+
+def leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=False, vectorized=False):
     """
     Computes a suite of deterministic skill metrics given two DataArrays
     corresponding to model and observations, which must share the same
@@ -133,6 +184,11 @@ def leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=False):
         an OBS DataArray dimensioned (season,year,...)
     detrend (optional): bool
         defaults to False; if True, skill scores computed after detrending
+    vectorized (optional): bool
+        defaults to False; if True, OBS are gathered onto the (Y,L)
+        verification times once (see align_obs) and the metrics for all
+        leads are computed together, masking verification times outside
+        the OBS record, instead of looping over L. Returns the same Dataset.
 
     Returns
     -------
@@ -142,6 +198,8 @@ def leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=False):
 
     # default seasons
     seasons = {1: 'DJF', 4: 'MAM', 7: 'JJA', 10: 'SON'}
+    if vectorized:
+        return _leadtime_skill_seas_vectorized(mod_da, mod_time, obs_da, seasons, detrend)
     corr_list = []
     pval_list = []
     rmse_list = []
@@ -191,7 +249,56 @@ def leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=False):
     return xr_dataset
 
 
-def leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, sampsize, N, detrend=False):
+def _leadtime_skill_seas_vectorized(mod_da, mod_time, obs_da, seasons, detrend):
+    """
+    All-leads version of leadtime_skill_seas. Verification times missing
+    from the OBS record are masked, and metrics are computed over Y with
+    missing values skipped; metrics are then set to NaN wherever the loop
+    over L would propagate a NaN (missing values within the OBS record or
+    an all-missing ensemble mean).
+    """
+
+    # OBS (season,year,...) as a time series at the centre month of each season
+    centre = {name: month for month, name in seasons.items()}
+    obs_ts = obs_da.stack(time=('year', 'season'))
+    obs_time = [cftime.DatetimeNoLeap(int(yy), centre[ss], 15)
+                for yy, ss in zip(obs_ts.year.values, obs_ts.season.values)]
+    obs_ts = obs_ts.drop_vars(['time', 'year', 'season']).assign_coords(time=obs_time)
+    b, valid = align_obs(mod_time, obs_ts.transpose('time', ...))
+    b = b.drop_vars(mod_time.coords)
+    a = mod_da.where(valid)
+    # perform linear detrending if detrend is set to True
+    if detrend:
+        a = detrend_linear(a, 'Y')
+        b = detrend_linear(b, 'Y')
+    # calculate statistics
+    amean = a.mean('M')
+    sigobs = b.std('Y')
+    sigsig = amean.std('Y')
+    sigtot = a.std('Y').mean('M')
+    nanmask = ((amean.isnull() | b.isnull()) & valid).any('Y')
+    # compute Pearson's correlation coefficient
+    r = xs.pearson_r(amean, b, dim='Y', skipna=True)
+    rpc = r / (sigsig / sigtot)
+
+    xr_dataset = xr.Dataset({'corr': r,
+                             'pval': xs.pearson_r_eff_p_value(amean, b, dim='Y', skipna=True),
+                             'nrmse': xs.rmse(amean, b, dim='Y', skipna=True) / sigobs,
+                             'msss': 1 - (xs.mse(amean, b, dim='Y', skipna=True) /
+                                          b.var('Y')),
+                             'rpc': rpc.where(r > 0)}).where(~nanmask)
+
+    # convert L to leadtime values and label the verification seasons
+    month = mod_time.isel(Y=0).dt.month.values
+    xr_dataset = xr_dataset.assign_coords(L=mod_da.L.values - 2,
+                                          season=('L', [seasons[mm] for mm in month]))
+    other_dims = [dim for dim in mod_da.dims if dim not in ('Y', 'L', 'M')]
+
+    return xr_dataset.transpose('L', *other_dims, ...)
+
+
+def leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, sampsize, N, detrend=False,
+                               indexed=False, seed=None, analytic=False, block=100):
     """
     Computes a suite of deterministic skill metrics given two DataArrays
     corresponding to model and observations, which must share the same
@@ -218,6 +325,21 @@ def leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, sampsize, N, detrend=Fa
         maximum dimension for resampling
     detrend : bool (optional)
         defaults to False; if set to True, skill scores will be computed after detrending
+    indexed : bool (optional)
+        defaults to False; if set to True, only a (sampsize x N) table of member
+        indices is drawn (see resample_members) and the ensemble means of all
+        resampled ensembles are computed together as count-weighted sums over the
+        original members, without materializing resampled copies of mod_da
+    seed : int (optional)
+        seed for random number generation when indexed is True, default None
+    analytic : bool (optional)
+        defaults to False; if set to True, the expected skill of N-member ensembles
+        is estimated from the variance components of the full ensemble with
+        expected_ensemble_skill (sampsize is then not used), instead of by
+        Monte Carlo resampling
+    block : int (optional)
+        number of resampled ensembles processed together when indexed is True,
+        which bounds the memory used; default 100
 
     Returns
     -------
@@ -233,6 +355,12 @@ def leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, sampsize, N, detrend=Fa
     # Perform resampling
     if (not N < mod_da.M.size):
         raise ValueError('ERROR: expecting resampled ensemble size to be less than original')
+    if analytic:
+        return _leadtime_skill_seas_analytic(mod_da, mod_time, obs_da, N, seasons, detrend)
+    if indexed:
+        index = resample_members(mod_da.M.size, N, sampsize, seed=seed)
+        return _leadtime_skill_seas_indexed(mod_da, mod_time, obs_da, index, seasons,
+                                            detrend, block=block)
     mod_da_r = xs.resample_iterations(mod_da.chunk(), sampsize, 'M', dim_max=N)
     for l in mod_da_r.iteration.values:
         # create lists for skill metrics
@@ -286,6 +414,228 @@ def leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, sampsize, N, detrend=Fa
     return dsout
 
 
+def resample_members(nmem, N, iterations, replace=True, seed=None):
+    """
+    Draws the member indices of resampled ensembles, as an integer table
+    instead of resampled copies of the data.
+
+    Parameters
+    ----------
+    nmem : int
+        size of the original ensemble (M)
+    N : int
+        size of the resampled ensembles
+    iterations : int
+        number of resampled ensembles
+    replace : bool (optional)
+        defaults to True; if False, members are drawn without replacement
+    seed : int (optional)
+        seed for random number generation, default None
+
+    Returns
+    -------
+    index : array
+        integer array dimensioned (iterations, N) of member positions
+    """
+
+    rng = np.random.default_rng(seed)
+    if replace:
+        return rng.integers(0, nmem, size=(iterations, N))
+
+    return np.argsort(rng.random((iterations, nmem)), axis=1)[:, :N]
+
+
+def _member_weights(index, members):
+    """
+    Converts a resample_members index table into an (iteration,M) DataArray
+    of member counts divided by the ensemble size, so that a dot product over
+    M gives the ensemble mean of each resampled ensemble.
+    """
+
+    counts = np.zeros((index.shape[0], members.size))
+    np.add.at(counts, (np.arange(index.shape[0])[:, None], index), 1)
+
+    return xr.DataArray(counts / index.shape[1], dims=('iteration', 'M'),
+                        coords={'M': members.values})
+
+
+def _weighted_member_mean(weights, da):
+    """
+    Ensemble means of da for every row of weights, skipping missing members.
+    """
+
+    return xr.dot(weights, da.fillna(0)) / xr.dot(weights, da.notnull())
+
+
+def _leadtime_skill_seas_indexed(mod_da, mod_time, obs_da, index, seasons, detrend,
+                                 block=100):
+    """
+    leadtime_skill_seas_resamp for the resampled ensembles in a
+    resample_members index table. Ensemble means and mean member standard
+    deviations of the resampled ensembles are weighted sums over the
+    original members, computed for at most block ensembles at a time, so
+    memory does not grow with the number of resampled ensembles.
+    """
+
+    weights = _member_weights(index, mod_da.M)
+    dslist = []
+    # convert L to leadtime values:
+    leadtime = mod_da.L - 2
+
+    for i in mod_da.L.values:
+        # adjust ensemble time to correct format
+        ens_ts = mod_da.sel(L=i).rename({'Y': 'time'})
+        ens_time_year = mod_time.sel(L=i).dt.year.data
+        ens_time_month = mod_time.sel(L=i).dt.month.data[0]
+        obs_ts = obs_da.sel(season=seasons[ens_time_month]).rename({'year': 'time'})
+        ens_ts = ens_ts.assign_coords(time=("time", ens_time_year))
+        a, b = xr.align(ens_ts, obs_ts)
+        # perform linear detrending if detrend is set to True
+        if detrend:
+            a = detrend_linear(a, 'time')
+            b = detrend_linear(b, 'time')
+        # accumulate the skill metrics of the resampled ensembles block by block
+        total = count = None
+        for j in range(0, weights.sizes['iteration'], block):
+            ds = _indexed_skill(weights.isel(iteration=slice(j, j + block)), a, b).compute()
+            if total is None:
+                total, count = ds.sum('iteration'), ds.count('iteration')
+            else:
+                total, count = total + ds.sum('iteration'), count + ds.count('iteration')
+        # mean of the resampled skill score distribution
+        dslist.append(total / count.where(count > 0))
+
+    # concatenate along leadtime dimension
+    dsout = xr.concat(dslist, leadtime)
+
+    return dsout
+
+
+def _indexed_skill(weights, a, b):
+    """
+    Skill metrics of the resampled ensembles given by the rows of weights
+    (see _member_weights) for one lead, dimensioned (iteration,...).
+    """
+
+    amean = _weighted_member_mean(weights, a)
+    sigobs = b.std('time')
+    sigsig = amean.std('time')
+    sigtot = _weighted_member_mean(weights, a.std('time'))
+    # compute Pearson's correlation coefficient
+    r = xs.pearson_r(amean, b, dim='time')
+    rpc = r / (sigsig / sigtot)
+
+    return xr.Dataset({'corr': r,
+                       'pval': xs.pearson_r_eff_p_value(amean, b, dim='time'),
+                       'rmse': xs.rmse(amean, b, dim='time') / sigobs,
+                       'msss': 1 - (xs.mse(amean, b, dim='time') / b.var('time')),
+                       'rpc': rpc.where(r > 0)})
+
+
+def _leadtime_skill_seas_analytic(mod_da, mod_time, obs_da, N, seasons, detrend):
+    """
+    leadtime_skill_seas_resamp with the expected skill of N-member ensembles
+    drawn with replacement, from expected_ensemble_skill.
+    """
+
+    dslist = []
+    # convert L to leadtime values:
+    leadtime = mod_da.L - 2
+
+    for i in mod_da.L.values:
+        # adjust ensemble time to correct format
+        ens_ts = mod_da.sel(L=i).rename({'Y': 'time'})
+        ens_time_year = mod_time.sel(L=i).dt.year.data
+        ens_time_month = mod_time.sel(L=i).dt.month.data[0]
+        obs_ts = obs_da.sel(season=seasons[ens_time_month]).rename({'year': 'time'})
+        ens_ts = ens_ts.assign_coords(time=("time", ens_time_year))
+        a, b = xr.align(ens_ts, obs_ts)
+        # perform linear detrending if detrend is set to True
+        if detrend:
+            a = detrend_linear(a, 'time')
+            b = detrend_linear(b, 'time')
+        dslist.append(expected_ensemble_skill(a, b, N)[['corr', 'pval', 'rmse', 'msss', 'rpc']])
+
+    # concatenate along leadtime dimension
+    dsout = xr.concat(dslist, leadtime).compute()
+
+    return dsout
+
+
+def expected_ensemble_skill(a, b, N, dim='time', replace=True):
+    """
+    Estimates the expected skill of N-member ensembles drawn from the M
+    members of a, from the variance components of the full ensemble, in one
+    pass instead of by Monte Carlo resampling of members.
+
+    Writing the ensemble mean of a drawn ensemble as the full ensemble mean
+    plus a sampling error e, e has zero mean and variance f/N times the
+    spread of the members about the full ensemble mean, with f = 1 when
+    drawing with replacement and f = (M-N)/(M-1) without. The expected mse,
+    ensemble-mean variance (sig_sig**2) and ensemble-mean/OBS covariance, and
+    hence msss, are then exact; sig_tot (mean member standard deviation) is
+    unchanged. corr, rmse, rpc, s2t and pval are plug-in estimates from these
+    expectations (the p-value uses the effective sample size of the full
+    ensemble mean).
+
+    Parameters
+    ----------
+    a : DataArray
+        hindcast DataArray with dimensions dim and M
+    b : DataArray
+        OBS DataArray with dimension dim, aligned with a
+    N : int
+        size of the drawn ensembles
+    dim : str (optional)
+        dimension over which skill is computed; defaults to 'time'
+    replace : bool (optional)
+        defaults to True; if False, members are drawn without replacement
+
+    Returns
+    -------
+    dsout : Dataset
+        expected corr, pval, rmse, msss, rpc, sig_obs, sig_sig, sig_tot and s2t
+    """
+
+    nmem = a.M.size
+    f = 1. if replace else (nmem - N) / (nmem - 1)
+    amean = a.mean('M')
+    spread = a - amean
+
+    # expectations over drawn ensembles
+    mse = xs.mse(amean, b, dim=dim) + f / N * (spread ** 2).mean('M').mean(dim)
+    sigsig = np.sqrt(amean.var(dim) + f / N * spread.var(dim).mean('M'))
+    cov = ((amean - amean.mean(dim)) * (b - b.mean(dim))).mean(dim)
+    sigobs = b.std(dim)
+    sigtot = a.std(dim).mean('M')
+
+    corr = cov / (sigsig * sigobs)
+    s2t = sigsig / sigtot
+
+    # p-value for the expected correlation, as xs.pearson_r_eff_p_value
+    n = amean.count(dim)
+    auto = _lag1_autocorr(amean, dim) * _lag1_autocorr(b, dim)
+    dof = np.clip(np.floor(n * (1 - auto) / (1 + auto)), 0, n) - 2
+    t_squared = corr ** 2 * (dof / ((1. - corr) * (1. + corr)))
+    x = dof / (dof + t_squared)
+    pval = special.betainc(0.5 * dof, 0.5, x.where(x < 1., 1.)).where(corr.notnull())
+
+    return xr.Dataset({'corr': corr, 'pval': pval, 'rmse': np.sqrt(mse) / sigobs,
+                       'msss': 1 - mse / b.var(dim), 'rpc': (corr / s2t).where(corr > 0),
+                       'sig_obs': sigobs, 'sig_sig': sigsig, 'sig_tot': sigtot, 's2t': s2t})
+
+
+def _lag1_autocorr(x, dim):
+    """
+    Lag-1 autocorrelation of x along dim.
+    """
+
+    head = x.isel({dim: slice(None, -1)}).drop_vars(dim, errors='ignore')
+    tail = x.isel({dim: slice(1, None)}).drop_vars(dim, errors='ignore')
+
+    return xs.pearson_r(head, tail, dim=dim)
+
+
 def remove_drift(da, da_time, y1, y2):
     """
     Function to convert raw DP DataArray into anomaly DP DataArray
@@ -329,7 +679,147 @@ def remove_drift(da, da_time, y1, y2):
 
     return da_anom, da_climo
 
-def compute_skill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,resamp=0,detrend=False):
+
+def skill_kernel(a, b):
+    """
+    Fused single-pass skill kernel. Accumulates the sums, squares and
+    (lag-1) cross-products over time of the ensemble mean and OBS, and the
+    sums and squares of every member, and derives the metrics of
+    compute_skill_annual from these sufficient statistics: corr, pval
+    (effective sample size p-value, as xs.pearson_r_eff_p_value), rmse
+    (normalized by sig_obs), msss, rpc (NaN where corr <= 0), sig_obs,
+    sig_sig, sig_tot (mean member standard deviation) and s2t. Standard
+    deviations skip missing values; the other metrics are NaN if any value
+    is missing, as in xskillscore.
+
+    Parameters
+    ----------
+    a : array
+        hindcast array dimensioned (...,time,M)
+    b : array
+        OBS array dimensioned (...,time)
+
+    Returns
+    -------
+    metrics : tuple
+        arrays dimensioned (...), in the order of SKILL_METRICS
+    """
+
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.sum(np.nan_to_num(a), axis=-1) / np.sum(~np.isnan(a), axis=-1)
+        n = x.shape[-1]
+        missing = np.isnan(x).any(axis=-1) | np.isnan(b).any(axis=-1)
+
+        # sums over time, shifted by the first value for accuracy
+        sx, sxx, nx = _shifted_sums(x)
+        sy, syy, ny = _shifted_sums(b)
+        sa, saa, na = _shifted_sums(np.moveaxis(a, -1, -2))
+        sxy = np.sum(_shift(x) * _shift(b), axis=-1)
+        sdd = np.sum((x - b) ** 2, axis=-1)
+
+        sig_obs = np.sqrt(np.maximum(syy / ny - (sy / ny) ** 2, 0))
+        sig_sig = np.sqrt(np.maximum(sxx / nx - (sx / nx) ** 2, 0))
+        sig_tot = np.nanmean(np.sqrt(np.maximum(saa / na - (sa / na) ** 2, 0)), axis=-1)
+        varx = sxx / n - (sx / n) ** 2
+        vary = syy / n - (sy / n) ** 2
+        corr = np.clip((sxy / n - sx * sy / n ** 2) / np.sqrt(varx * vary), -1., 1.)
+        mse = sdd / n
+        rmse = np.sqrt(mse) / sig_obs
+        msss = 1 - mse / vary
+
+        # effective sample size from the lag-1 autocorrelations
+        auto = _lag1_corr(x, sx, sxx) * _lag1_corr(b, sy, syy)
+        neff = np.clip(np.floor(n * (1 - auto) / (1 + auto)), 0, n)
+        dof = neff - 2
+        t_squared = corr ** 2 * (dof / ((1. - corr) * (1. + corr)))
+        pval = special.betainc(0.5 * dof, 0.5, np.minimum(dof / (dof + t_squared), 1.))
+        pval = np.where(np.isnan(corr), np.nan, pval)
+
+        s2t = sig_sig / sig_tot
+        rpc = np.where(corr > 0, corr / s2t, np.nan)
+
+    corr, pval, rmse, msss, rpc = [np.where(missing, np.nan, metric)
+                                   for metric in (corr, pval, rmse, msss, rpc)]
+
+    return corr, pval, rmse, msss, rpc, sig_obs, sig_sig, sig_tot, s2t
+
+
+def _shifted_sums(x):
+    """
+    Sum, sum of squares and count of the valid values of x along its last
+    axis, after subtracting the first value (see _shift).
+    """
+
+    dx = _shift(x)
+    valid = ~np.isnan(dx)
+    dx = np.where(valid, dx, 0.)
+
+    return np.sum(dx, axis=-1), np.sum(dx * dx, axis=-1), np.sum(valid, axis=-1)
+
+
+def _shift(x):
+    """
+    Subtracts the first value of x along its last axis (if not missing),
+    which keeps sums of squares accurate for data far from zero.
+    """
+
+    return x - np.nan_to_num(x[..., :1])
+
+
+def _lag1_corr(x, sx, sxx):
+    """
+    Lag-1 autocorrelation of x along its last axis, from the shifted sums
+    of x (see _shifted_sums) and one product of consecutive values.
+    """
+
+    dx = _shift(x)
+    m = x.shape[-1] - 1
+    slag = np.sum(dx[..., :-1] * dx[..., 1:], axis=-1)
+    shead = sx - dx[..., -1]
+    stail = sx - dx[..., 0]
+    vhead = (sxx - dx[..., -1] ** 2) / m - (shead / m) ** 2
+    vtail = (sxx - dx[..., 0] ** 2) / m - (stail / m) ** 2
+
+    return np.clip((slag / m - shead * stail / m ** 2) / np.sqrt(vhead * vtail), -1., 1.)
+
+
+def fused_skill(a, b, dim='time'):
+    """
+    Computes the metrics of compute_skill_annual (see SKILL_METRICS) with
+    the fused skill_kernel, applied with xr.apply_ufunc so that it works on
+    NumPy and (parallelized) dask arrays alike.
+
+    Parameters
+    ----------
+    a : DataArray
+        hindcast DataArray with dimensions dim and M
+    b : DataArray
+        OBS DataArray with dimension dim, aligned with a
+    dim : str (optional)
+        dimension over which skill is computed; defaults to 'time'
+
+    Returns
+    -------
+    dsout : Dataset
+        set of skill score metrics
+    """
+
+    if a.chunks is not None:
+        a = a.chunk({dim: -1, 'M': -1})
+    if b.chunks is not None:
+        b = b.chunk({dim: -1})
+    metrics = xr.apply_ufunc(skill_kernel, a, b,
+                             input_core_dims=[[dim, 'M'], [dim]],
+                             output_core_dims=[[] for name in SKILL_METRICS],
+                             dask='parallelized',
+                             output_dtypes=[np.float64 for name in SKILL_METRICS])
+
+    return xr.Dataset(dict(zip(SKILL_METRICS, metrics)))
+
+
+def compute_skill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,resamp=0,detrend=False,fused=False):
     """
     Computes a suite of deterministic skill metrics given two DataArrays
     corresponding to model and observations, which must share the same
@@ -353,6 +843,9 @@ def compute_skill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,resamp=0,det
         number of resamplings of individual-member timeseries for computing forecast variance.
     detrend : bool (optional)
         defaults to False; if set to True, skill scores will be computed after detrending
+    fused : bool (optional)
+        defaults to False; if set to True, all metrics are derived in a single pass
+        with fused_skill instead of separate xskillscore/xarray reductions
 
     Returns
     -------
@@ -366,6 +859,8 @@ def compute_skill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,resamp=0,det
     lvalsda = xr.DataArray(np.arange(nleads)+1,dims="L",name="L")
     if (nleadavg>1):
         obs_ts = obs_da.rolling(time=nleadavg,min_periods=nleadavg, center=True).mean().dropna('time')
+    else:
+        obs_ts = obs_da
     for i in range(nleads):
         leadisel = lvals + i 
         ens_ts = mod_da.isel(L=leadisel).mean('L').rename({'Y':'time'})
@@ -376,6 +871,23 @@ def compute_skill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,resamp=0,det
         if detrend:
                 a = detrend_linear(a,'time')
                 b = detrend_linear(b,'time')
+        if fused:
+            stats = fused_skill(a,b,dim='time')
+            sigtot = stats['sig_tot']
+            if (resamp>0):
+                a_resamp = xs.resample_iterations_idx(a, resamp, 'M', dim_max=1).squeeze()
+                sigtot = a_resamp.std('time').mean('iteration')
+            s2t = stats['sig_sig']/sigtot
+            corr_list.append(stats['corr'])
+            rpc_list.append((stats['corr']/s2t).where(stats['corr']>0))
+            rmse_list.append(stats['rmse'])
+            msss_list.append(stats['msss'])
+            pval_list.append(stats['pval'])
+            sigobs_list.append(stats['sig_obs'])
+            sigsig_list.append(stats['sig_sig'])
+            sigtot_list.append(sigtot)
+            s2t_list.append(s2t)
+            continue
         amean = a.mean('M')
         sigobs = b.std('time')
         sigsig = amean.std('time')
@@ -408,7 +920,7 @@ def compute_skill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,resamp=0,det
     s2t  = xr.concat(s2t_list,lvalsda)
     return xr.Dataset({'corr':corr,'pval':pval,'rmse':rmse,'msss':msss,'rpc':rpc,'sig_obs':sigo,'sig_sig':sigs,'sig_tot':sigt,'s2t':s2t})
 
-def compute_skill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1,nleads=1,resamp=0,detrend=False,monthly=False):
+def compute_skill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1,nleads=1,resamp=0,detrend=False,monthly=False,fused=False):
     """
     Computes a suite of deterministic skill metrics given two DataArrays
     corresponding to model and observations, which must share the same
@@ -439,6 +951,9 @@ def compute_skill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1,nlead
     monthly : bool (optional)
         set to True if mod_da and obs_da are monthly means (skill will be computed for each lead month
         instead of each lead season)
+    fused : bool (optional)
+        defaults to False; if set to True, all metrics are derived in a single pass
+        with fused_skill instead of separate xskillscore/xarray reductions
 
     Returns
     -------
@@ -470,6 +985,23 @@ def compute_skill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1,nlead
         if detrend:
                 a = detrend_linear(a,'time')
                 b = detrend_linear(b,'time')
+        if fused:
+            stats = fused_skill(a,b,dim='time')
+            sigtot = stats['sig_tot']
+            if (resamp>0):
+                a_resamp = xs.resample_iterations_idx(a, resamp, 'M', dim_max=1).squeeze()
+                sigtot = a_resamp.std('time').mean('iteration')
+            s2t = stats['sig_sig']/sigtot
+            corr_list.append(stats['corr'])
+            rpc_list.append((stats['corr']/s2t).where(stats['corr']>0))
+            rmse_list.append(stats['rmse'])
+            msss_list.append(stats['msss'])
+            pval_list.append(stats['pval'])
+            sigobs_list.append(stats['sig_obs'])
+            sigsig_list.append(stats['sig_sig'])
+            sigtot_list.append(sigtot)
+            s2t_list.append(s2t)
+            continue
         amean = a.mean('M')
         sigobs = b.std('time')
         sigsig = amean.std('time')
@@ -540,55 +1072,54 @@ def compute_resampskill_annual(mod_da,mod_time,obs_da,nleadavg=1,nleads=1,detren
     dsout : DataArray
         set of skill score metrics
     """
-    dslist = []
+    corr_list = []; pval_list = []; rmse_list = []; msss_list = []; rpc_list = []
+    sigsig_list = []; sigtot_list = []; s2t_list = []
     if (nleadavg>1):
         obs_ts = obs_da.rolling(time=nleadavg,min_periods=nleadavg, center=True).mean().dropna('time')
+    else:
+        obs_ts = obs_da
     lvals = np.arange(nleadavg)
     lvalsda = xr.DataArray(np.arange(nleads),dims="L",name="L")
-    for l in mod_da.iteration.values:
-        corr_list = []; pval_list = []; rmse_list = []; msss_list = []; rpc_list = []
-        sigobs_list = []; sigsig_list = []; sigtot_list = []; s2t_list = []
-        for i in range(nleads):
-            ens_ts = mod_da.sel(iteration=l).isel(L=lvals+i).mean('L').rename({'Y':'time'})
-            ens_time_year = mod_time.isel(L=lvals+i).mean('L').data
-            ens_ts = ens_ts.assign_coords(time=("time",ens_time_year))
-            a,b = xr.align(ens_ts,obs_ts)
-            b = b - b.mean('time')
-            if detrend:
-                a = detrend_linear(a,'time')
-                b = detrend_linear(b,'time')
-            amean = a.mean('M')
-            sigobs = b.std('time')
-            sigsig = amean.std('time')
-            if (resamp>0):
-                iterations = resamp
-                ens_size = 1
-                a_resamp = xs.resample_iterations_idx(a, iterations, 'M', dim_max=ens_size).squeeze()
-                sigtot = a_resamp.std('time').mean('iteration')
-            else:
-                sigtot = a.std('time').mean('M')
-            r = xs.pearson_r(amean,b,dim='time')
-            rpc = r/(sigsig/sigtot)
-            corr_list.append(r)
-            rpc_list.append(rpc.where(r>0))
-            rmse_list.append(xs.rmse(amean,b,dim='time')/sigobs)
-            msss_list.append(1-(xs.mse(amean,b,dim='time')/b.var('time')))
-            pval_list.append(xs.pearson_r_eff_p_value(amean,b,dim='time'))
-            sigsig_list.append(sigsig)
-            sigtot_list.append(sigtot)
-            s2t_list.append(sigsig/sigtot)
-        corr = xr.concat(corr_list,lvalsda)
-        pval = xr.concat(pval_list,lvalsda)
-        rmse = xr.concat(rmse_list,lvalsda)
-        msss = xr.concat(msss_list,lvalsda)
-        rpc = xr.concat(rpc_list,lvalsda)
-        sigs = xr.concat(sigsig_list,lvalsda)
-        sigt = xr.concat(sigtot_list,lvalsda)
-        s2t  = xr.concat(s2t_list,lvalsda)
-        dslist.append(xr.Dataset({'corr':corr,'pval':pval,'rmse':rmse,'msss':msss,'rpc':rpc,'sig_sig':sigs,'sig_tot':sigt,'s2t':s2t}))
-    dsout = xr.concat(dslist,dim='iteration')
+    # the iteration dimension is carried through as an ordinary broadcast dimension
+    for i in range(nleads):
+        ens_ts = mod_da.isel(L=lvals+i).mean('L').rename({'Y':'time'})
+        ens_time_year = mod_time.isel(L=lvals+i).mean('L').data
+        ens_ts = ens_ts.assign_coords(time=("time",ens_time_year))
+        a,b = xr.align(ens_ts,obs_ts)
+        b = b - b.mean('time')
+        if detrend:
+            a = detrend_linear(a,'time')
+            b = detrend_linear(b,'time')
+        amean = a.mean('M')
+        sigobs = b.std('time')
+        sigsig = amean.std('time')
+        if (resamp>0):
+            sigtot = _resampled_sigtot(a,resamp)
+        else:
+            sigtot = a.std('time').mean('M')
+        r = xs.pearson_r(amean,b,dim='time')
+        rpc = r/(sigsig/sigtot)
+        corr_list.append(r)
+        rpc_list.append(rpc.where(r>0))
+        rmse_list.append(xs.rmse(amean,b,dim='time')/sigobs)
+        msss_list.append(1-(xs.mse(amean,b,dim='time')/b.var('time')))
+        pval_list.append(xs.pearson_r_eff_p_value(amean,b,dim='time'))
+        sigsig_list.append(sigsig)
+        sigtot_list.append(sigtot)
+        s2t_list.append(sigsig/sigtot)
+    corr = xr.concat(corr_list,lvalsda)
+    pval = xr.concat(pval_list,lvalsda)
+    rmse = xr.concat(rmse_list,lvalsda)
+    msss = xr.concat(msss_list,lvalsda)
+    rpc = xr.concat(rpc_list,lvalsda)
+    sigs = xr.concat(sigsig_list,lvalsda)
+    sigt = xr.concat(sigtot_list,lvalsda)
+    s2t  = xr.concat(s2t_list,lvalsda)
+    dsout = xr.Dataset({'corr':corr,'pval':pval,'rmse':rmse,'msss':msss,'rpc':rpc,'sig_sig':sigs,'sig_tot':sigt,'s2t':s2t})
     if (mean):
         dsout = dsout.mean('iteration')
+    else:
+        dsout = dsout.transpose('iteration',...)
     return dsout
 
 def compute_resampskill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1,nleads=1,detrend=False,resamp=0,mean=True,monthly=False):
@@ -635,7 +1166,8 @@ def compute_resampskill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1
     dsout : DataArray
         set of skill score metrics
     """
-    dslist = []
+    corr_list = []; pval_list = []; rmse_list = []; msss_list = []; rpc_list = []
+    sigsig_list = []; sigtot_list = []; s2t_list = []
     if (monthly):
         lvals = np.arange(nleadavg)*12
     else:
@@ -643,59 +1175,68 @@ def compute_resampskill_seasonal(mod_da,mod_time,obs_da,climy0,climy1,nleadavg=1
     # Convert to leadtime values
     lvalsda = xr.DataArray(mod_da.isel(L=slice(0,nleads)).L-2,dims="L",name="L")
     
-    for l in mod_da.iteration.values:
-        corr_list = []; pval_list = []; rmse_list = []; msss_list = []; rpc_list = []
-        sigobs_list = []; sigsig_list = []; sigtot_list = []; s2t_list = []
-        for i in range(nleads):
-            leadisel = lvals + i 
-            ens_ts = mod_da.sel(iteration=l).isel(L=leadisel).mean('L').rename({'Y':'time'})
-            ens_time_year = mod_time.isel(L=leadisel).mean('L').dt.year
-            ens_time_month = mod_time.isel(L=leadisel).mean('L').dt.month.data[0]
-            ens_ts = ens_ts.assign_coords(time=("time",ens_time_year.data))
-            obsisel = obs_da.time.dt.month==ens_time_month
-            obs_seas = obs_da.isel(time=obsisel)
-            obs_seas = obs_seas - obs_seas.sel(time=slice(climy0,climy1)).mean('time')
-            obs_seas = obs_seas.assign_coords(time=("time",obs_seas.time.dt.year.data))
-            if (nleadavg>1):
-                obs_seas = obs_seas.rolling(time=nleadavg,min_periods=nleadavg, center=True).mean().dropna('time',how='all')
-            a,b = xr.align(ens_ts,obs_seas)
-            if detrend:
-                a = detrend_linear(a,'time')
-                b = detrend_linear(b,'time')
-            amean = a.mean('M')
-            sigobs = b.std('time')
-            sigsig = amean.std('time')
-            if (resamp>0):
-                iterations = resamp
-                ens_size = 1
-                a_resamp = xs.resample_iterations_idx(a, iterations, 'M', dim_max=ens_size).squeeze()
-                sigtot = a_resamp.std('time').mean('iteration')
-            else:
-                sigtot = a.std('time').mean('M')
-            r = xs.pearson_r(amean,b,dim='time')
-            rpc = r/(sigsig/sigtot)
-            corr_list.append(r)
-            rpc_list.append(rpc.where(r>0))
-            rmse_list.append(xs.rmse(amean,b,dim='time')/sigobs)
-            msss_list.append(1-(xs.mse(amean,b,dim='time')/b.var('time')))
-            pval_list.append(xs.pearson_r_eff_p_value(amean,b,dim='time'))
-            sigobs_list.append(sigobs)
-            sigsig_list.append(sigsig)
-            sigtot_list.append(sigtot)
-            s2t_list.append(sigsig/sigtot)
-        corr = xr.concat(corr_list,lvalsda)
-        pval = xr.concat(pval_list,lvalsda)
-        rmse = xr.concat(rmse_list,lvalsda)
-        msss = xr.concat(msss_list,lvalsda)
-        rpc = xr.concat(rpc_list,lvalsda)
-        sigo = xr.concat(sigobs_list,lvalsda)
-        sigs = xr.concat(sigsig_list,lvalsda)
-        sigt = xr.concat(sigtot_list,lvalsda)
-        s2t  = xr.concat(s2t_list,lvalsda)
-        dslist.append(xr.Dataset({'corr':corr,'pval':pval,'rmse':rmse,'msss':msss,'rpc':rpc,'sig_sig':sigs,'sig_tot':sigt,'s2t':s2t}))
-    dsout = xr.concat(dslist,dim='iteration')
+    # the iteration dimension is carried through as an ordinary broadcast dimension
+    for i in range(nleads):
+        leadisel = lvals + i 
+        ens_ts = mod_da.isel(L=leadisel).mean('L').rename({'Y':'time'})
+        ens_time_year = mod_time.isel(L=leadisel).mean('L').dt.year
+        ens_time_month = mod_time.isel(L=leadisel).mean('L').dt.month.data[0]
+        ens_ts = ens_ts.assign_coords(time=("time",ens_time_year.data))
+        obsisel = obs_da.time.dt.month==ens_time_month
+        obs_seas = obs_da.isel(time=obsisel)
+        obs_seas = obs_seas - obs_seas.sel(time=slice(climy0,climy1)).mean('time')
+        obs_seas = obs_seas.assign_coords(time=("time",obs_seas.time.dt.year.data))
+        if (nleadavg>1):
+            obs_seas = obs_seas.rolling(time=nleadavg,min_periods=nleadavg, center=True).mean().dropna('time',how='all')
+        a,b = xr.align(ens_ts,obs_seas)
+        if detrend:
+            a = detrend_linear(a,'time')
+            b = detrend_linear(b,'time')
+        amean = a.mean('M')
+        sigobs = b.std('time')
+        sigsig = amean.std('time')
+        if (resamp>0):
+            sigtot = _resampled_sigtot(a,resamp)
+        else:
+            sigtot = a.std('time').mean('M')
+        r = xs.pearson_r(amean,b,dim='time')
+        rpc = r/(sigsig/sigtot)
+        corr_list.append(r)
+        rpc_list.append(rpc.where(r>0))
+        rmse_list.append(xs.rmse(amean,b,dim='time')/sigobs)
+        msss_list.append(1-(xs.mse(amean,b,dim='time')/b.var('time')))
+        pval_list.append(xs.pearson_r_eff_p_value(amean,b,dim='time'))
+        sigsig_list.append(sigsig)
+        sigtot_list.append(sigtot)
+        s2t_list.append(sigsig/sigtot)
+    corr = xr.concat(corr_list,lvalsda)
+    pval = xr.concat(pval_list,lvalsda)
+    rmse = xr.concat(rmse_list,lvalsda)
+    msss = xr.concat(msss_list,lvalsda)
+    rpc = xr.concat(rpc_list,lvalsda)
+    sigs = xr.concat(sigsig_list,lvalsda)
+    sigt = xr.concat(sigtot_list,lvalsda)
+    s2t  = xr.concat(s2t_list,lvalsda)
+    dsout = xr.Dataset({'corr':corr,'pval':pval,'rmse':rmse,'msss':msss,'rpc':rpc,'sig_sig':sigs,'sig_tot':sigt,'s2t':s2t})
     if (mean):
         dsout = dsout.mean('iteration')
+    else:
+        dsout = dsout.transpose('iteration',...)
     return dsout
 
 
+def _resampled_sigtot(a,resamp):
+    """
+    Mean standard deviation of resamp individual members drawn (with
+    replacement) from a. If a carries an 'iteration' dimension, members are
+    drawn independently for every iteration, as in a loop over iterations.
+    """
+    sig = a.std('time')
+    if ('iteration' in a.dims):
+        shape, dims = (a.sizes['iteration'],resamp), ('iteration','_resamp')
+    else:
+        shape, dims = (resamp,), ('_resamp',)
+    index = xr.DataArray(np.random.randint(0,a.sizes['M'],shape),dims=dims)
+    return sig.isel(M=index).mean('_resamp')
+
+
@@ -2,14 +2,33 @@ import cftime
 from functools import partial
 import glob
 import numpy as np
+import os
+import shutil
+import pytest
 import sys
 import xarray as xr
 
 from esp_lab.data_access import time_set_midmonth
+from esp_lab.data_access import build_catalog
+from esp_lab.data_access import catalog_index
+from esp_lab.data_access import build_references
+from esp_lab.data_access import ingest_zarr
+from esp_lab.data_access import open_zarr_store
 from esp_lab.data_access import file_dict
+from esp_lab.data_access import file_index
+from esp_lab.data_access import parse_template
 from esp_lab.data_access import get_monthly_data
+from esp_lab.data_access import iter_monthly_data
 from esp_lab.data_access import nested_file_list_by_year
 from esp_lab.data_access import preprocessor
+from esp_lab.data_access import seasonal_mean
+from esp_lab.data_access import region_weights
+from esp_lab.data_access import apply_weights
+from esp_lab.data_access import regrid_weights
+from esp_lab.data_access import subset_region
+from esp_lab.data_access import lead_chunks
+from esp_lab.data_access import midmonth_from_num
+from esp_lab.data_access import midmonth_from_yearmonth
 
 
 def test_file_dict():
@@ -28,28 +47,262 @@ def test_file_dict():
     assert len(filepaths.keys()) == 3
 
 
+def test_file_index():
+    """
+    Test the file_index function.
+    """
+
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    filetype = '.pop.h.'
+
+    index = file_index(filetemplate, filetype)
+
+    assert list(index.keys()) == [('zsatcalc', 2, 3)]
+    assert index[('zsatcalc', 2, 3)] == file_dict(filetemplate, filetype, 3, 2)
+
+    # concurrent directory listing finds the same files
+    assert file_index(filetemplate, filetype, nthreads=4) == index
+    assert file_index('tests/test_data/*/*.nc', filetype, nthreads=4) == {}
+
+
+def test_parse_template(tmp_path):
+    """
+    Test the parse_template function and named templates in file_index.
+    """
+    template = parse_template('{year:4d}/{case}.{year:4d}-{month:02d}.{member:03d}.cam.h0.'
+                              '{field}.*.nc')
+    assert template.glob == '????/*.????-??.???.cam.h0.*.*.nc'
+    assert template.types == {'year': int, 'case': str, 'month': int, 'member': int,
+                              'field': str}
+    match = template.regex.fullmatch('1954/b.e11.BDP.f09_g16.1954-11.001.cam.h0.TS.'
+                                     '195411-196412.nc')
+    assert match.groupdict() == {'year': '1954', 'case': 'b.e11.BDP.f09_g16',
+                                 'month': '11', 'member': '001', 'field': 'TS'}
+    # repeated keys must match the same value
+    assert template.regex.fullmatch('1955/b.e11.BDP.f09_g16.1954-11.001.cam.h0.TS.'
+                                    '195411-196412.nc') is None
+    with pytest.raises(ValueError):
+        parse_template('{year:4s}.nc')
+
+    # an archive with a different layout is indexed in one scan
+    for yy in [1954, 1955]:
+        (tmp_path / str(yy)).mkdir()
+        for mem in [1, 2]:
+            name = 'b.e11.BDP.f09_g16.{}-11.{:03d}.cam.h0.TS.{}11-{}12.nc'.format(
+                yy, mem, yy, yy + 10)
+            (tmp_path / str(yy) / name).touch()
+    (tmp_path / '1955' / 'b.e11.BDP.f09_g16.1954-11.001.cam.h0.TS.195411-196412.nc').touch()
+    filetemplate = str(tmp_path / '{year:4d}' / '{case}.{year:4d}-{month:02d}.{member:03d}'
+                       '.cam.h0.{field}.*.nc')
+    index = file_index(filetemplate, '.cam.h0.')
+    assert sorted(index) == [('TS', 11, 1), ('TS', 11, 2)]
+    assert index[('TS', 11, 2)][1955] == str(tmp_path / '1955' / 'b.e11.BDP.f09_g16.1955-11.'
+                                             '002.cam.h0.TS.195511-196512.nc')
+    assert file_index(filetemplate, '.cam.h0.', nthreads=2) == index
+
+    # same hindcast as the SMYLE template
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 3, 'zsatcalc', [1986, 1987], 2,
+                           preprocessor)
+    filetemplate = ('tests/test_data/{case}.{year:4d}-{month:02d}.{member:03d}.pop.h.'
+                    '{field}.*.nc')
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 3, 'zsatcalc', [1986, 1987], 2,
+                           preprocessor)
+    assert ds1.identical(ds0)
+
+    # regression: the field may be left out of single-field templates
+    filetemplate = ('tests/test_data/{case}.{year:4d}-{month:02d}.{member:03d}.pop.h.'
+                    'zsatcalc.*.nc')
+    ds2 = get_monthly_data(filetemplate, '.pop.h.', 3, 3, 'zsatcalc', [1986, 1987], 2,
+                           preprocessor)
+    assert ds2.identical(ds0)
+
+
+def test_build_catalog(tmp_path):
+    """
+    Test the build_catalog and catalog_index functions.
+    """
+
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    filetype = '.pop.h.'
+    catalog = str(tmp_path / 'catalog.db')
+
+    # second build finds no modified directories
+    assert build_catalog(filetemplate, filetype, catalog) == 1
+    assert build_catalog(filetemplate, filetype, catalog) == 0
+
+    index = catalog_index(catalog, filetemplate)
+    assert index == file_index(filetemplate, filetype)
+
+    nested_files = nested_file_list_by_year(filetemplate, filetype, 3, [1986, 1987], 2,
+                                            catalog=catalog)
+    assert nested_files[1] == [1986, 1987]
+
+
+def test_build_catalog_fields(tmp_path):
+    """
+    Test the build_catalog function with two fields in one directory.
+    """
+    _write_small_files(tmp_path, ['zsatcalc', 'zsatarag'], [2])
+
+    # keep the catalog outside the scanned directory
+    (tmp_path / 'catalog').mkdir()
+    catalog = str(tmp_path / 'catalog' / 'catalog.db')
+    templates = [str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.{0}.*.nc'.format(field))
+                 for field in ['zsatcalc', 'zsatarag']]
+    for template in templates:
+        assert build_catalog(template, '.pop.h.', catalog) == 1
+    for template in templates:
+        assert build_catalog(template, '.pop.h.', catalog) == 0
+        index = catalog_index(catalog, template)
+        assert index == file_index(template, '.pop.h.')
+        assert len(index) == 1
+
+    # rescanning one field keeps the other
+    os.utime(tmp_path, (0, 0))
+    assert build_catalog(templates[0], '.pop.h.', catalog) == 1
+    assert catalog_index(catalog, templates[1]) == file_index(templates[1], '.pop.h.')
+
+    # files rewritten in place are recataloged, and found stale until then
+    file = glob.glob(str(tmp_path / '*1986-02.003.pop.h.zsatarag*.nc'))[0]
+    with open(file, 'ab') as fh:
+        fh.write(b'0')
+    os.utime(tmp_path, (0, 0))
+    with pytest.raises(ValueError):
+        catalog_index(catalog, templates[1])
+    assert catalog_index(catalog, templates[1], check=False) == file_index(templates[1],
+                                                                           '.pop.h.')
+    assert build_catalog(templates[1], '.pop.h.', catalog) == 1
+    assert build_catalog(templates[1], '.pop.h.', catalog) == 0
+    assert catalog_index(catalog, templates[1]) == file_index(templates[1], '.pop.h.')
+
+    # wildcards do not match files in nested directories
+    (tmp_path / 'old').mkdir()
+    for file in glob.glob(str(tmp_path / '*zsatcalc*.nc')):
+        shutil.copy(file, tmp_path / 'old')
+    template = str(tmp_path / '*.????-MM.EEE.pop.h.zsatcalc.*.nc')
+    assert build_catalog(str(tmp_path / 'old' / os.path.basename(templates[0])),
+                         '.pop.h.', catalog) == 1
+    assert catalog_index(catalog, template) == file_index(template, '.pop.h.')
+
+
 def test_get_monthly_data():
     """
     Test the get_monthly_data function.
     """
-    # filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
-    # filetype = '.pop.h.'
-    # ens = 3
-    # firstyear = 1986
-    # lastyear = 1988
-    # stmon = 2
-    # nlead = 24
-    # field = 'zsatcalc'
-    # preproc = preprocessor
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    filetype = '.pop.h.'
+    ens = 3
+    start_years = [1986, 1987, 1988]
+    stmon = 2
+    nlead = 12
+    field = 'zsatcalc'
 
-    # ds0 = get_monthly_data(filetemplate, filetype, ens, nlead, field,
-    #                  firstyear, lastyear, stmon, preproc)
+    ds0 = get_monthly_data(filetemplate, filetype, ens, nlead, field,
+                           start_years, stmon, preprocessor)
 
-    # print("ds0 {}".format(ds0))
+    assert ds0[field].dims == ('Y', 'L', 'M', 'nlat', 'nlon')
+    assert ds0[field].shape == (3, 12, 1, 384, 320)
+    assert ds0.time.dims == ('Y', 'L')
+    assert ds0.time.values[1, 0] == cftime.DatetimeNoLeap(1987, 2, 15)
 
-    # todo: make test
+    # sharing the decoded time axis gives the same result
+    ds1 = get_monthly_data(filetemplate, filetype, ens, nlead, field,
+                           start_years, stmon, preprocessor, share_time=True)
+    assert (ds1.time.values == ds0.time.values).all()
+    assert ds1[field].isel(Y=0, L=0).equals(ds0[field].isel(Y=0, L=0))
 
-    assert True
+    # only the time axis is left undecoded for preproc
+    dtypes = []
+
+    def recording(ds, nlead, field):
+        dtypes.append((ds.time.dtype.kind, ds.time_bound.dtype.kind))
+        return preprocessor(ds, nlead, field)
+
+    ds2 = get_monthly_data(filetemplate, filetype, ens, nlead, field, start_years, stmon,
+                           recording, share_time=True)
+    assert set(dtypes) == {('f', 'O')}
+    assert (ds2.time.values == ds0.time.values).all()
+    ds3 = get_monthly_data(filetemplate, filetype, ens, nlead, field, start_years, stmon,
+                           partial(preprocessor, freq='season'), share_time=True)
+    ds4 = get_monthly_data(filetemplate, filetype, ens, nlead, field, start_years, stmon,
+                           partial(preprocessor, freq='season'))
+    assert (ds3.time.values == ds4.time.values).all()
+
+
+def test_build_references(tmp_path):
+    """
+    Test the build_references function and opening the hindcast through it.
+    """
+    pytest.importorskip('kerchunk')
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    filetype = '.pop.h.'
+    start_years = [1986, 1987, 1988]
+    reffile = str(tmp_path / 'refs.json')
+
+    file_list, yrs = nested_file_list_by_year(filetemplate, filetype, 3, start_years, 2)
+    build_references(file_list, yrs, reffile)
+
+    ds0 = get_monthly_data(filetemplate, filetype, 3, 12, 'zsatcalc',
+                           start_years, 2, preprocessor)
+    ds1 = get_monthly_data(filetemplate, filetype, 3, 12, 'zsatcalc',
+                           start_years, 2, preprocessor, references=reffile)
+
+    assert ds1.zsatcalc.dims == ds0.zsatcalc.dims
+    assert (ds1.time.values == ds0.time.values).all()
+    assert ds1.zsatcalc.isel(Y=2, L=-1).equals(ds0.zsatcalc.isel(Y=2, L=-1))
+
+
+def test_ingest_zarr(tmp_path):
+    """
+    Test the ingest_zarr and open_zarr_store functions.
+    """
+    pytest.importorskip('zarr')
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    filetype = '.pop.h.'
+    store = str(tmp_path / 'zsatcalc.zarr')
+
+    # later calls only append the missing start years
+    assert ingest_zarr(filetemplate, filetype, 3, 6, 'zsatcalc', [1987], 2,
+                       preprocessor, store) == [1987]
+    assert ingest_zarr(filetemplate, filetype, 3, 6, 'zsatcalc', [1986, 1987, 1988], 2,
+                       preprocessor, store) == [1986, 1988]
+    assert ingest_zarr(filetemplate, filetype, 3, 6, 'zsatcalc', [1986, 1987, 1988], 2,
+                       preprocessor, store) == []
+
+    ds0 = get_monthly_data(filetemplate, filetype, 3, 6, 'zsatcalc',
+                           [1986, 1987, 1988], 2, preprocessor)
+    ds1 = open_zarr_store(store)
+
+    assert list(ds1.Y.values) == [1986, 1987, 1988]
+    assert ds1.zsatcalc.equals(ds0.zsatcalc)
+    assert (ds1.time.values == ds0.time.values).all()
+
+
+def test_iter_monthly_data():
+    """
+    Test the iter_monthly_data function.
+    """
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    filetype = '.pop.h.'
+    start_years = [1986, 1987, 1988]
+
+    ds0 = get_monthly_data(filetemplate, filetype, 3, 6, 'zsatcalc', start_years, 2,
+                           preprocessor)
+    mean0 = ds0.zsatcalc.mean(('nlat', 'nlon'))
+
+    def reduce(ds):
+        return ds.zsatcalc.mean(('nlat', 'nlon'))
+
+    blocks = list(iter_monthly_data(filetemplate, filetype, 3, 6, 'zsatcalc', start_years, 2,
+                                    preprocessor, block=2, reduce=reduce))
+    assert [list(b.Y.values) for b in blocks] == [[1986, 1987], [1988]]
+    assert xr.concat(blocks, 'Y').equals(mean0.compute())
+
+    blocks = list(iter_monthly_data(filetemplate, filetype, 3, 6, 'zsatcalc', start_years, 2,
+                                    preprocessor, by_member=True, reduce=reduce))
+    assert len(blocks) == 3
+    assert blocks[1].equals(mean0.sel(Y=[1987]).compute())
 
 
 def test_nested_file_list_by_year():
@@ -66,6 +319,16 @@ def test_nested_file_list_by_year():
 
     assert nested_files[1][2] == 1988
 
+    index = file_index(filetemplate, filetype)
+    assert nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon,
+                                    index=index) == nested_files
+
+    # index entries of templates without {field} match any field
+    index = file_index('tests/test_data/{case}.{year:4d}-{month:02d}.{member:03d}.pop.h.'
+                       'zsatcalc.*.nc', filetype)
+    assert nested_file_list_by_year(filetemplate, filetype, ens, start_years, stmon,
+                                    index=index, field='zsatcalc') == nested_files
+
 
 def test_bad_nested_file_list_by_year():
     """
@@ -91,10 +354,390 @@ def test_preprocessor():
     assert True
 
 
+def _write_small_files(path, fields, stmons):
+    """
+    Write reduced copies of the test files for several fields and start months.
+    """
+    for file in sorted(glob.glob('tests/test_data/*.nc')):
+        ds = xr.open_dataset(file)[['zsatcalc', 'time_bound']].isel(nlat=slice(0, 4),
+                                                                    nlon=slice(0, 5))
+        for stmon in stmons:
+            # shift the time axis to the new start month
+            shift = stmon - 2
+            ds['time'] = [cftime.DatetimeNoLeap(t.year + (t.month + shift - 1) // 12,
+                                                (t.month + shift - 1) % 12 + 1, 1)
+                          for t in xr.open_dataset(file).time.values]
+            for field in fields:
+                name = file.split('/')[-1].replace('zsatcalc', field)
+                name = name.replace('-02.', '-{0:02d}.'.format(stmon))
+                ds.rename({'zsatcalc': field}).to_netcdf(path / name)
+
+
+def test_get_monthly_data_fields(tmp_path):
+    """
+    Test the get_monthly_data function with a list of fields.
+    """
+    _write_small_files(tmp_path, ['zsatcalc', 'zsatarag'], [2])
+
+    filetemplate = str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.*.nc')
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, ['zsatcalc', 'zsatarag'],
+                           [1986, 1987, 1988], 2, preprocessor)
+
+    assert ds0.zsatcalc.dims == ('Y', 'L', 'M', 'nlat', 'nlon')
+    assert ds0.zsatcalc.equals(ds0.zsatarag.rename('zsatcalc'))
+    assert ds0.time.values[2, 5] == cftime.DatetimeNoLeap(1988, 7, 15)
+
+    # a single field is picked out of an index of several fields
+    index = file_index(filetemplate, '.pop.h.')
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatarag', [1986, 1987, 1988], 2,
+                           preprocessor, index=index)
+    assert ds1.zsatarag.equals(ds0.zsatarag)
+    blocks = list(iter_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatarag', [1986], 2,
+                                    preprocessor, index=index, by_member=True))
+    assert blocks[0].zsatarag.equals(ds0.zsatarag.sel(Y=[1986]))
+
+
+def test_get_monthly_data_stmons(tmp_path):
+    """
+    Test the get_monthly_data function with a list of start months.
+    """
+    _write_small_files(tmp_path, ['zsatcalc'], [2, 5, 8, 11])
+
+    filetemplate = str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc')
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc',
+                           [1986, 1987, 1988], [2, 5, 8, 11], preprocessor)
+
+    assert ds0.zsatcalc.dims == ('Y', 'L', 'M', 'S', 'nlat', 'nlon')
+    assert list(ds0.S.values) == [2, 5, 8, 11]
+    assert ds0.time.sel(S=11).values[0, 0] == cftime.DatetimeNoLeap(1986, 11, 15)
+
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc',
+                           [1986, 1987, 1988], 5, preprocessor)
+    assert ds0.zsatcalc.sel(S=5, drop=True).equals(ds1.zsatcalc)
+    assert (ds0.time.sel(S=5).values == ds1.time.values).all()
+
+    # files with different time units share one decoding
+    ds2 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc',
+                           [1986, 1987, 1988], [2, 5, 8, 11], preprocessor, share_time=True)
+    assert (ds2.time.values == ds0.time.values).all()
+
+
+def test_get_monthly_data_direct(tmp_path):
+    """
+    Test the get_monthly_data function with method='direct'.
+    """
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 12, 'zsatcalc',
+                           [1986, 1987, 1988], 2, preprocessor)
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 12, 'zsatcalc',
+                           [1986, 1987, 1988], 2, preprocessor, method='direct')
+
+    # same hindcast as open_mfdataset with the default preprocessor
+    assert ds1.zsatcalc.dims == ('Y', 'L', 'M', 'nlat', 'nlon')
+    assert ds1.zsatcalc.chunks[0] == (1, 1, 1)
+    np.testing.assert_array_equal(ds1.zsatcalc.values, ds0.zsatcalc.values)
+    assert (ds1.time.values == ds0.time.values).all()
+    assert ds1.attrs == ds0.attrs
+    assert ds1.zsatcalc.attrs == ds0.zsatcalc.attrs
+    for name in ['TLONG', 'TLAT', 'ULONG', 'ULAT']:
+        assert ds1[name].dims == ('nlat', 'nlon')
+        assert ds1[name].attrs == ds0[name].attrs
+        np.testing.assert_array_equal(ds1[name].values, ds0[name].values)
+
+    # several start months, read from a hyperslab
+    _write_small_files(tmp_path, ['zsatcalc'], [2, 5])
+    filetemplate = str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc')
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987], [2, 5],
+                           preprocessor, region={'nlat': slice(1, 3)})
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987], [2, 5],
+                           preprocessor, region={'nlat': slice(1, 3)}, method='direct')
+    assert ds1.zsatcalc.dims == ('Y', 'L', 'M', 'S', 'nlat', 'nlon')
+    assert ds1.TLONG.shape == (2, 5)
+    np.testing.assert_array_equal(ds1.zsatcalc.values, ds0.zsatcalc.values)
+    assert (ds1.time.values == ds0.time.values).all()
+
+    with pytest.raises(ValueError):
+        get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986], 2,
+                         preprocessor, method='unknown')
+
+
+def test_get_monthly_data_processes(tmp_path):
+    """
+    Test the get_monthly_data function with method='processes'.
+    """
+    _write_small_files(tmp_path, ['zsatcalc'], [2, 5])
+    filetemplate = str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc')
+
+    for stmon in [2, [2, 5]]:
+        ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987, 1988],
+                               stmon, preprocessor).load()
+        ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987, 1988],
+                               stmon, preprocessor, method='processes', max_workers=2)
+        # same hindcast as open_mfdataset, already in memory
+        assert ds1.zsatcalc.chunks is None
+        xr.testing.assert_identical(ds1.drop_vars('time'), ds0.drop_vars('time'))
+        assert (ds1.time.values == ds0.time.values).all()
+        ds2 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987, 1988],
+                               stmon, preprocessor, method='processes', max_workers=2,
+                               share_time=True)
+        assert (ds2.time.values == ds0.time.values).all()
+
+    # a start year with more members than the others is refused
+    file = glob.glob(str(tmp_path / '*1986-02.003*.nc'))[0]
+    shutil.copy(file, file.replace('.003.', '.002.'))
+    with pytest.raises(ValueError):
+        get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987, 1988],
+                         2, preprocessor, method='processes', max_workers=2)
+
+
+def test_get_monthly_data_cache(tmp_path):
+    """
+    Test the get_monthly_data function with a result cache.
+    """
+    _write_small_files(tmp_path, ['zsatcalc'], [2])
+    filetemplate = str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc')
+    cache_dir = tmp_path / 'cache'
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, preprocessor)
+
+    # the result is written once and reopened by repeated calls
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, preprocessor, cache_dir=str(cache_dir))
+    cached = glob.glob(str(cache_dir / '*.nc'))
+    assert len(cached) == 1
+    ds2 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, preprocessor, cache_dir=str(cache_dir))
+    assert glob.glob(str(cache_dir / '*.nc')) == cached
+    for ds in [ds1, ds2]:
+        np.testing.assert_array_equal(ds.zsatcalc.values, ds0.zsatcalc.values)
+        assert (ds.time.values == ds0.time.values).all()
+
+    # other arguments, preprocessor arguments, methods or modified files give new entries
+    ds3 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, partial(preprocessor, freq='season'), cache_dir=str(cache_dir),
+                           method='direct')
+    assert len(glob.glob(str(cache_dir / '*.nc'))) == 2
+    ds4 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, partial(preprocessor, freq='season'), cache_dir=str(cache_dir))
+    assert len(glob.glob(str(cache_dir / '*.nc'))) == 3
+    assert ds3.sizes['L'] == 6
+    ds5 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, partial(preprocessor, freq='season'))
+    assert ds4.sizes['L'] == ds5.sizes['L'] < 6
+    os.utime(glob.glob(str(tmp_path / '*1986-02*.nc'))[0], (0, 0))
+    get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                     2, preprocessor, cache_dir=str(cache_dir))
+    assert len(glob.glob(str(cache_dir / '*.nc'))) == 4
+
+    # closures which only differ in the values they capture give new entries
+    def make_preproc(scale):
+        def scaled(ds0, nlead, field):
+            ds0 = preprocessor(ds0, nlead, field)
+            ds0[field] = ds0[field] * scale
+            return ds0
+        return scaled
+
+    ds6 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, make_preproc(1), cache_dir=str(cache_dir))
+    ds7 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                           2, make_preproc(1000), cache_dir=str(cache_dir))
+    assert len(glob.glob(str(cache_dir / '*.nc'))) == 6
+    np.testing.assert_allclose(ds7.zsatcalc.values, 1000 * ds6.zsatcalc.values)
+
+    # arguments without a deterministic hash are not cached
+    class Scale:
+        def __rmul__(self, other):
+            return other
+
+    with pytest.warns(UserWarning):
+        ds8 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                               2, make_preproc(Scale()), cache_dir=str(cache_dir))
+    assert len(glob.glob(str(cache_dir / '*.nc'))) == 6
+    assert ds8.zsatcalc.equals(ds6.zsatcalc)
+
+    # least recently used entries are removed beyond cache_maxsize
+    get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986, 1987],
+                     2, preprocessor, cache_dir=str(cache_dir), cache_maxsize=1)
+    assert len(glob.glob(str(cache_dir / '*.nc'))) == 1
+
+
+def test_lead_chunks():
+    """
+    Test the lead_chunks function.
+    """
+    file = 'tests/test_data/b.e21.BSMYLE.f09_g17.1986-02.003.pop.h.zsatcalc.198602-198801.nc'
+
+    assert lead_chunks(file, 'zsatcalc', 6) == {'time': 6, 'nlat': 384, 'nlon': 320}
+    assert lead_chunks(file, 'zsatcalc', 30, {'nlat': 100}) == {'time': 24, 'nlat': 100,
+                                                                 'nlon': 320}
+    assert lead_chunks(file, 'zsatcalc', 6, {'time': 1}) == {'time': 1}
+
+
+def test_subset_region():
+    """
+    Test the subset_region function.
+    """
+    ds = xr.Dataset({'x': (('lat', 'lon'), np.arange(18 * 36).reshape(18, 36))},
+                    coords={'lon': np.arange(0., 360., 10.), 'lat': np.arange(-85., 90., 10.)})
+
+    # a box across longitude 0 is read as two slabs in geographic order
+    sub = subset_region(ds, (280, 20, 20, 80))
+    assert list(sub.lon.values) == [280, 290, 300, 310, 320, 330, 340, 350, 0, 10, 20]
+    assert list(sub.lat.values) == [25, 35, 45, 55, 65, 75]
+    assert subset_region(ds, (-80, 20, 20, 80)).equals(sub)
+
+    sub = subset_region(ds, {'lat': slice(0, 2)})
+    assert sub.x.shape == (2, 36)
+
+    # index slices are applied to each file as it is opened
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 6, 'zsatcalc', [1986], 2,
+                           preprocessor, region={'nlat': slice(0, 10), 'nlon': slice(5, 25)})
+    assert ds0.zsatcalc.shape == (1, 6, 1, 10, 20)
+
+
+def test_seasonal_mean(tmp_path):
+    """
+    Test the seasonal_mean function.
+    """
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    region = {'nlat': slice(0, 3), 'nlon': slice(100, 103)}
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 24, 'zsatcalc', [1986, 1987], 2,
+                           preprocessor, region=region)
+
+    # February starts; MAM is the first complete season
+    seas = seasonal_mean(ds0)
+    assert list(seas.L.values) == [3, 6, 9, 12, 15, 18, 21]
+    assert seas.time.values[0, 0] == cftime.DatetimeNoLeap(1986, 4, 15)
+    weights = np.array([31, 30, 31]) / 92.
+    expected = np.tensordot(weights, ds0.zsatcalc.isel(L=[1, 2, 3]).values, axes=([0], [1]))
+    np.testing.assert_allclose(seas.zsatcalc.isel(L=0).values, expected, rtol=1e-6)
+
+    # the same average can be applied in the preprocessor
+    ds1 = get_monthly_data(filetemplate, '.pop.h.', 3, 24, 'zsatcalc', [1986, 1987], 2,
+                           partial(preprocessor, freq='season'), region=region)
+    assert ds1.zsatcalc.equals(seas.zsatcalc)
+
+    annual = seasonal_mean(ds0.zsatcalc, freq='annual', time=ds0.time)
+    assert annual.shape == (2, 1, 1, 3, 3)
+
+    # every start month is averaged over its own calendar
+    _write_small_files(tmp_path, ['zsatcalc'], [2, 5])
+    filetemplate = str(tmp_path / 'b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc')
+    ds2 = get_monthly_data(filetemplate, '.pop.h.', 3, 24, 'zsatcalc', [1986, 1987], [2, 5],
+                           preprocessor)
+    for freq in ['season', 'annual']:
+        result = seasonal_mean(ds2, freq=freq)
+        for stmon in [2, 5]:
+            ds3 = get_monthly_data(filetemplate, '.pop.h.', 3, 24, 'zsatcalc', [1986, 1987],
+                                   stmon, preprocessor)
+            expected = seasonal_mean(ds3, freq=freq)
+            nper = result.sizes['L']
+            assert result.zsatcalc.sel(S=stmon, drop=True).equals(
+                expected.zsatcalc.isel(L=slice(0, nper)))
+            assert (result.time.sel(S=stmon).values ==
+                    expected.time.isel(L=slice(0, nper)).values).all()
+
+
+def test_region_weights():
+    """
+    Test the region_weights and apply_weights functions.
+    """
+    file = 'tests/test_data/b.e21.BSMYLE.f09_g17.1986-02.003.pop.h.zsatcalc.198602-198801.nc'
+    ds = xr.open_dataset(file)
+    da = ds.zsatcalc.isel(time=slice(0, 3))
+    regions = {'nino34': (190, 240, -5, 5), 'natl': (280, 20, 20, 60),
+               'triangle': [(200, 0), (220, 0), (210, 20)]}
+
+    weights = region_weights(ds.TLONG, ds.TLAT, regions, area=ds.TAREA)
+    result = apply_weights(da, weights)
+    assert result.dims == ('time', 'region')
+
+    # same as a masked weighted mean, including a box wrapping across 0
+    lon = ds.TLONG % 360
+    masks = {'nino34': (lon >= 190) & (lon <= 240) & (abs(ds.TLAT) <= 5),
+             'natl': ((lon >= 280) | (lon <= 20)) & (ds.TLAT >= 20) & (ds.TLAT <= 60)}
+    for name, mask in masks.items():
+        expected = da.where(mask).weighted(ds.TAREA).mean(('nlat', 'nlon'))
+        np.testing.assert_allclose(result.sel(region=name).values, expected.values)
+
+    # regional means can be taken in the preprocessor, file by file
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 3, 'zsatcalc', [1986], 2,
+                           partial(preprocessor, weights=weights))
+    assert ds0.zsatcalc.dims == ('Y', 'L', 'M', 'region')
+    np.testing.assert_allclose(ds0.zsatcalc.values[0, :, 0], result.values)
+
+
+def test_regrid_weights(tmp_path):
+    """
+    Test the regrid_weights function.
+    """
+    lon = np.arange(0.5, 360, 1.)
+    lat = np.arange(-89.5, 90, 1.)
+    da = xr.DataArray(np.random.rand(2, lat.size, lon.size), dims=('time', 'lat', 'lon'),
+                      coords={'lat': lat, 'lon': lon})
+    dst_lon = np.arange(2.5, 360, 5.)
+    dst_lat = np.arange(-87.5, 90, 5.)
+
+    weights = regrid_weights(da.lon, da.lat, dst_lon, dst_lat, cache_dir=str(tmp_path))
+    result = apply_weights(da, weights)
+    assert result.dims == ('time', 'lat', 'lon')
+    assert result.shape == (2, 36, 72)
+
+    # conservative: area-weighted global means are preserved
+    src_area = np.diff(np.sin(np.deg2rad(np.arange(-90, 91, 1.))))[:, None]
+    dst_area = 5 * np.diff(np.sin(np.deg2rad(np.arange(-90, 91, 5.))))[:, None]
+    np.testing.assert_allclose((result * dst_area).sum(('lat', 'lon')),
+                               (da * src_area).sum(('lat', 'lon')))
+
+    # weights are cached on disk and reused
+    assert len(glob.glob(str(tmp_path / 'regrid_*.npz'))) == 1
+    cached = regrid_weights(da.lon, da.lat, dst_lon, dst_lat, cache_dir=str(tmp_path))
+    assert (cached.matrix != weights.matrix).nnz == 0
+
+    # curvilinear POP grid, regridded file by file in the preprocessor
+    file = 'tests/test_data/b.e21.BSMYLE.f09_g17.1986-02.003.pop.h.zsatcalc.198602-198801.nc'
+    ds = xr.open_dataset(file)
+    weights = regrid_weights(ds.TLONG, ds.TLAT, dst_lon, dst_lat, area=ds.TAREA)
+    filetemplate = 'tests/test_data/b.e21.BSMYLE.f09_g17.????-MM.EEE.pop.h.zsatcalc.*.nc'
+    ds0 = get_monthly_data(filetemplate, '.pop.h.', 3, 3, 'zsatcalc', [1986], 2,
+                           partial(preprocessor, weights=weights))
+    assert ds0.zsatcalc.dims == ('Y', 'L', 'M', 'lat', 'lon')
+    assert ds0.zsatcalc.shape == (1, 3, 1, 36, 72)
+    # each destination cell is the area-weighted mean of the cells centred in it
+    inside = (ds.TLAT >= 0) & (ds.TLAT < 5) & (ds.TLONG >= 210) & (ds.TLONG < 215)
+    expected = ds.zsatcalc.isel(time=0).where(inside).weighted(ds.TAREA).mean()
+    np.testing.assert_allclose(ds0.zsatcalc.sel(lat=2.5, lon=212.5).values[0, 0, 0],
+                               expected.values)
+
+
 def test_time_set_midmonth():
     """
     Test the time_set_midmonth function.
     """
-    test = True
+    file = 'tests/test_data/b.e21.BSMYLE.f09_g17.1986-02.003.pop.h.zsatcalc.198602-198801.nc'
+
+    ds = time_set_midmonth(xr.open_dataset(file), 'time')
+    assert ds.time.values[0] == cftime.DatetimeNoLeap(1986, 2, 15)
+    assert ds.time.values[-1] == cftime.DatetimeNoLeap(1988, 1, 15)
+
+    # raw numeric time values give the same mid-month dates
+    ds_num = time_set_midmonth(xr.open_dataset(file, decode_times=False), 'time')
+    assert (ds_num.time.values == ds.time.values).all()
+
+
+def test_midmonth_from_num():
+    """
+    Test the midmonth_from_num function.
+    """
+    dates = [cftime.DatetimeNoLeap(1999, 12, 1), cftime.DatetimeNoLeap(2000, 1, 1),
+             cftime.DatetimeNoLeap(2000, 3, 1)]
+    expected = [cftime.DatetimeNoLeap(1999, 11, 15), cftime.DatetimeNoLeap(1999, 12, 15),
+                cftime.DatetimeNoLeap(2000, 2, 15)]
+
+    for units in ['days since 0000-01-01', 'hours since 1850-01-01 00:00:00']:
+        values = cftime.date2num(dates, units, calendar='noleap')
+        assert list(midmonth_from_num(values, units)) == expected
 
-    assert test
+    assert list(midmonth_from_yearmonth([1999, 2000, 2000], [12, 1, 3])) == expected
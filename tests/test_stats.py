@@ -1,4 +1,5 @@
 import cftime
+import itertools
 import numpy as np
 import pandas as pd
 import pytest
@@ -6,11 +7,20 @@ import sys
 import xarray as xr
 import xskillscore as xs
 
+from esp_lab.stats import align_obs
+from esp_lab.stats import compute_resampskill_annual
+from esp_lab.stats import compute_resampskill_seasonal
+from esp_lab.stats import compute_skill_annual
+from esp_lab.stats import compute_skill_seasonal
 from esp_lab.stats import cor_ci_bootyears
 from esp_lab.stats import detrend_linear
+from esp_lab.stats import expected_ensemble_skill
+from esp_lab.stats import fused_skill
 from esp_lab.stats import leadtime_skill_seas
 from esp_lab.stats import leadtime_skill_seas_resamp
 from esp_lab.stats import remove_drift
+from esp_lab.stats import resample_members
+from esp_lab.stats import skill_kernel
 
 
 def test_cor_ci_bootyears():
@@ -93,22 +103,127 @@ def test_detrend_linear():
     assert final_dat.data[1][0][1] < 2.7
 
 
+def test_align_obs():
+    """
+    Test the align_obs function.
+    """
+    years = np.arange(1970, 1975)
+    leads = np.arange(1, 13)
+    mod_time = xr.DataArray([[cftime.DatetimeNoLeap(y + (m - 1) // 12, (m - 1) % 12 + 1, 15)
+                              for m in leads + 10] for y in years],
+                            dims=('Y', 'L'), coords={'Y': years, 'L': leads})
+    obs_time = [cftime.DatetimeNoLeap(1971 + i // 12, i % 12 + 1, 1) for i in range(36)]
+    obs_da = xr.DataArray(np.arange(36.)[:, None] * np.ones(2), dims=('time', 'x'),
+                          coords={'time': obs_time})
+
+    result, valid = align_obs(mod_time, obs_da)
+    assert result.dims == ('Y', 'L', 'x')
+    assert valid.sum() == 36
+
+    # same as selecting each verification month from the OBS record
+    for y in years:
+        for l in leads:
+            t = mod_time.sel(Y=y, L=l).item()
+            match = obs_da.time.dt.year * 12 + obs_da.time.dt.month == t.year * 12 + t.month
+            if match.any():
+                assert valid.sel(Y=y, L=l)
+                np.testing.assert_array_equal(result.sel(Y=y, L=l), obs_da[match.values][0])
+            else:
+                assert not valid.sel(Y=y, L=l)
+                assert result.sel(Y=y, L=l).isnull().all()
+
+
+def _synthetic_seasonal(nyears=20, nleads=8, nmem=5, npts=3, seed=0):
+    """
+    Seasonal hindcasts initialized in November, and OBS dimensioned
+    (season,year,x) covering only part of the verification period.
+    """
+    rng = np.random.default_rng(seed)
+    names = ['DJF', 'MAM', 'JJA', 'SON']
+    years = np.arange(1970, 1970 + nyears)
+    leads = np.arange(1, nleads + 1)
+    mod_time = xr.DataArray([[cftime.DatetimeNoLeap(y + 1 + 3 * (l - 1) // 12,
+                                                    3 * (l - 1) % 12 + 1, 15)
+                              for l in leads] for y in years],
+                            dims=('Y', 'L'), coords={'Y': years, 'L': leads})
+    signal = rng.standard_normal((nyears + nleads // 4 + 1, 4, npts))
+    obs_da = xr.DataArray(signal + 0.5 * rng.standard_normal(signal.shape),
+                          dims=('year', 'season', 'x'),
+                          coords={'year': np.arange(1970, 1970 + signal.shape[0]),
+                                  'season': names, 'x': np.arange(npts)})
+    obs_da = obs_da.transpose('season', 'year', 'x').isel(year=slice(1, -4))
+    mod = np.empty((nyears, nleads, nmem, npts))
+    for i in range(nyears):
+        for j in range(nleads):
+            t = mod_time.values[i, j]
+            mod[i, j] = (0.7 * signal[t.year - 1970, (t.month - 1) // 3] +
+                         rng.standard_normal((nmem, npts)))
+    mod_da = xr.DataArray(mod, dims=('Y', 'L', 'M', 'x'),
+                          coords={'Y': years, 'L': leads, 'M': np.arange(1, nmem + 1),
+                                  'x': np.arange(npts)})
+
+    return mod_da, mod_time, obs_da
+
+
 def test_leadtime_skill_seas():
     """
     Test the leadtime_skill_seas function.
     """
-    # todo: make test
+    mod_da, mod_time, obs_da = _synthetic_seasonal()
+    # missing values within the OBS record and in the hindcast
+    obs_da[:, :, 0] = np.nan
+    obs_da[1, 5, 1] = np.nan
 
-    assert True
+    for detrend in [False, True]:
+        result = leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=detrend)
+        assert result.corr.dims == ('L', 'x')
+        assert list(result.L.values) == list(mod_da.L.values - 2)
+
+        # all leads at once give the same metrics as the loop over leads
+        vectorized = leadtime_skill_seas(mod_da, mod_time, obs_da, detrend=detrend,
+                                         vectorized=True)
+        xr.testing.assert_allclose(vectorized, result)
+        assert list(vectorized.season.values) == list(result.season.values)
+
+
+def test_resample_members():
+    """
+    Test the resample_members function.
+    """
+    index = resample_members(10, 4, 100, seed=1)
+    assert index.shape == (100, 4)
+    assert index.min() >= 0 and index.max() < 10
+    assert (resample_members(10, 4, 100, seed=1) == index).all()
+
+    # without replacement every ensemble has distinct members
+    index = resample_members(10, 4, 100, replace=False, seed=1)
+    assert all(len(set(row)) == 4 for row in index)
 
 
 def test_leadtime_skill_seas_resamp():
     """
     Test the leadtime_skill_seas_resamp function.
     """
-    # todo: make test
+    mod_da, mod_time, obs_da = _synthetic_seasonal(nmem=10)
 
-    assert True
+    result = leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, 6, 4)
+    assert set(result.data_vars) == {'corr', 'pval', 'rmse', 'msss', 'rpc'}
+    assert result.corr.dims == ('L', 'x')
+
+    # indexed resampling scores the ensembles of the index table
+    indexed = leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, 6, 4, indexed=True, seed=3)
+    expected = [leadtime_skill_seas(mod_da.isel(M=index), mod_time, obs_da)
+                for index in resample_members(10, 4, 6, seed=3)]
+    expected = xr.concat(expected, 'iteration').mean('iteration').rename({'nrmse': 'rmse'})
+    xr.testing.assert_allclose(indexed, expected.transpose(*indexed.corr.dims))
+
+    # processing the resampled ensembles in blocks gives the same result
+    blocked = leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, 6, 4, indexed=True, seed=3,
+                                         block=4)
+    xr.testing.assert_allclose(blocked, indexed)
+
+    with pytest.raises(ValueError):
+        leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, 6, 10, indexed=True)
 
 
 def test_remove_drift():
@@ -118,3 +233,153 @@ def test_remove_drift():
     # todo: make test
 
     assert True
+
+
+def _synthetic_annual(nyears=30, nleads=5, nmem=8, npts=3, seed=1):
+    """
+    Annual hindcasts with year-valued verification times, and OBS of
+    absolute values (eg temperatures in K) covering the verification period.
+    """
+    rng = np.random.default_rng(seed)
+    years = np.arange(1960, 1960 + nyears)
+    leads = np.arange(1, nleads + 1)
+    mod_time = xr.DataArray(years[:, None] + leads[None, :] - 0.5, dims=('Y', 'L'),
+                            coords={'Y': years, 'L': leads})
+    signal = rng.standard_normal((nyears + nleads + 10, npts))
+    obs_da = xr.DataArray(280 + signal + 0.3 * rng.standard_normal(signal.shape),
+                          dims=('time', 'x'),
+                          coords={'time': np.arange(1955, 1955 + signal.shape[0]) + 0.5,
+                                  'x': np.arange(npts)})
+    index = (years - 1955)[:, None] + leads[None, :] - 1
+    mod = np.stack([280 + 0.6 * signal[index] + rng.standard_normal((nyears, nleads, npts))
+                    for m in range(nmem)], axis=2)
+    mod_da = xr.DataArray(mod, dims=('Y', 'L', 'M', 'x'),
+                          coords={'Y': years, 'L': leads, 'M': np.arange(1, nmem + 1),
+                                  'x': np.arange(npts)})
+
+    return mod_da, mod_time, obs_da
+
+
+def test_skill_kernel():
+    """
+    Test the skill_kernel and fused_skill functions.
+    """
+    mod_da, mod_time, obs_da = _synthetic_annual()
+    a = mod_da.isel(L=0).rename({'Y': 'time'}).assign_coords(time=obs_da.time[5:35].values)
+    b = obs_da.isel(time=slice(5, 35))
+    a[3, 1, 0] = np.nan
+
+    result = fused_skill(a, b)
+    amean = a.mean('M')
+    np.testing.assert_allclose(result.corr, xs.pearson_r(amean, b, dim='time'))
+    np.testing.assert_allclose(result.pval, xs.pearson_r_eff_p_value(amean, b, dim='time'))
+    np.testing.assert_allclose(result.rmse, xs.rmse(amean, b, dim='time') / b.std('time'))
+    np.testing.assert_allclose(result.msss, 1 - xs.mse(amean, b, dim='time') / b.var('time'))
+    np.testing.assert_allclose(result.sig_tot, a.std('time').mean('M'))
+
+    # same kernel on NumPy arrays and on dask arrays
+    metrics = skill_kernel(a.transpose('x', 'time', 'M').values, b.transpose('x', 'time').values)
+    np.testing.assert_allclose(metrics[0], result.corr)
+    lazy = fused_skill(a.chunk({'x': 1}), b.chunk({'x': 1}))
+    assert lazy.corr.chunks is not None
+    xr.testing.assert_allclose(lazy.compute(), result)
+
+    # missing OBS give missing metrics, but standard deviations skip them
+    b[4, 2] = np.nan
+    result = fused_skill(a, b)
+    assert np.isnan(result.corr[2]) and not np.isnan(result.sig_obs[2])
+
+
+def test_compute_skill_fused():
+    """
+    Test the compute_skill_annual and compute_skill_seasonal functions with fused=True.
+    """
+    mod_da, mod_time, obs_da = _synthetic_annual()
+    for nleadavg in [1, 3]:
+        for detrend in [False, True]:
+            result = compute_skill_annual(mod_da, mod_time, obs_da, nleadavg=nleadavg,
+                                          nleads=2, detrend=detrend)
+            assert result.corr.dims == ('L', 'x')
+            fused = compute_skill_annual(mod_da, mod_time, obs_da, nleadavg=nleadavg,
+                                         nleads=2, detrend=detrend, fused=True)
+            xr.testing.assert_allclose(fused, result)
+
+    mod_da, mod_time, obs_da = _synthetic_seasonal(nyears=30)
+    obs_da = obs_da.stack(time=('year', 'season'))
+    obs_time = [cftime.DatetimeNoLeap(yy, {'DJF': 1, 'MAM': 4, 'JJA': 7, 'SON': 10}[ss], 15)
+                for yy, ss in obs_da.time.values]
+    obs_da = obs_da.drop_vars(['time', 'year', 'season']).assign_coords(time=obs_time)
+    result = compute_skill_seasonal(mod_da, mod_time, obs_da, '1975', '1990', nleads=4)
+    fused = compute_skill_seasonal(mod_da, mod_time, obs_da, '1975', '1990', nleads=4,
+                                   fused=True)
+    xr.testing.assert_allclose(fused, result)
+
+
+def test_compute_resampskill():
+    """
+    Test the compute_resampskill_annual and compute_resampskill_seasonal functions.
+    """
+    mod_da, mod_time, obs_da = _synthetic_annual()
+    mod_da = xs.resample_iterations_idx(mod_da - 280, 4, 'M', dim_max=3)
+    obs_da = obs_da - 280
+
+    result = compute_resampskill_annual(mod_da, mod_time, obs_da, nleadavg=3, nleads=2,
+                                        mean=False)
+    assert result.corr.dims == ('iteration', 'L', 'x')
+    # each iteration is scored as its own resampled ensemble
+    for i in range(mod_da.iteration.size):
+        single = compute_resampskill_annual(mod_da.isel(iteration=[i]), mod_time, obs_da,
+                                            nleadavg=3, nleads=2, mean=False)
+        xr.testing.assert_allclose(single.isel(iteration=0), result.isel(iteration=i))
+    mean = compute_resampskill_annual(mod_da, mod_time, obs_da, nleadavg=3, nleads=2)
+    xr.testing.assert_allclose(mean, result.mean('iteration'))
+
+    # single-year leads and a resampled total standard deviation
+    result = compute_resampskill_annual(mod_da, mod_time, obs_da, nleads=2, resamp=5,
+                                        mean=False)
+    assert result.sig_tot.dims == ('iteration', 'L', 'x')
+    # members are drawn independently for every iteration
+    np.random.seed(0)
+    result = compute_resampskill_annual(mod_da.isel(iteration=[0, 0, 0, 0]), mod_time, obs_da,
+                                        nleads=2, resamp=20, mean=False)
+    assert not (result.sig_tot == result.sig_tot.isel(iteration=0)).all()
+
+    mod_da, mod_time, obs_da = _synthetic_seasonal(nyears=30)
+    mod_da = xs.resample_iterations_idx(mod_da, 4, 'M', dim_max=3)
+    obs_da = obs_da.stack(time=('year', 'season'))
+    obs_time = [cftime.DatetimeNoLeap(yy, {'DJF': 1, 'MAM': 4, 'JJA': 7, 'SON': 10}[ss], 15)
+                for yy, ss in obs_da.time.values]
+    obs_da = obs_da.drop_vars(['time', 'year', 'season']).assign_coords(time=obs_time)
+    result = compute_resampskill_seasonal(mod_da, mod_time, obs_da, '1975', '1990', nleads=4,
+                                          mean=False)
+    single = compute_resampskill_seasonal(mod_da.isel(iteration=[2]), mod_time, obs_da,
+                                          '1975', '1990', nleads=4, mean=False)
+    xr.testing.assert_allclose(single.isel(iteration=0), result.isel(iteration=2))
+
+
+def test_expected_ensemble_skill():
+    """
+    Test the expected_ensemble_skill function.
+    """
+    mod_da, mod_time, obs_da = _synthetic_seasonal(nmem=10)
+    a = mod_da.isel(L=2).rename({'Y': 'time'})
+    b = xr.DataArray(np.random.default_rng(0).standard_normal((a.time.size, a.x.size)),
+                     dims=('time', 'x'), coords={'time': a.time, 'x': a.x})
+
+    # expected msss and signal variance are exact over all 3-member ensembles
+    expected = expected_ensemble_skill(a, b, 3, replace=False)
+    subsets = [a.isel(M=list(members)).mean('M')
+               for members in itertools.combinations(range(10), 3)]
+    amean = xr.concat(subsets, 'iteration')
+    msss = 1 - xs.mse(amean, b, dim='time') / b.var('time')
+    np.testing.assert_allclose(expected.msss, msss.mean('iteration'))
+    np.testing.assert_allclose(expected.sig_sig ** 2, amean.var('time').mean('iteration'))
+    np.testing.assert_allclose(expected.sig_tot, a.std('time').mean('M'))
+
+    # analytic mode agrees with Monte Carlo resampling
+    analytic = leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, 0, 3, analytic=True)
+    montecarlo = leadtime_skill_seas_resamp(mod_da, mod_time, obs_da, 2000, 3,
+                                            indexed=True, seed=0)
+    assert analytic.corr.dims == montecarlo.corr.dims
+    xr.testing.assert_allclose(analytic.msss, montecarlo.msss, atol=0.03)
+    xr.testing.assert_allclose(analytic.corr, montecarlo.corr, atol=0.03)